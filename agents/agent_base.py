@@ -1,85 +1,884 @@
 from abc import ABC, abstractmethod
 from dotenv import load_dotenv
-import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.protobuf.struct_pb2 import Struct
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import inspect
 import json
 import logging
 from extensions import socketio
+from utils.async_loop import run_sync
+from utils.cancellation import TaskCancelled, CancelToken, call_cancellable, CANCEL_POLL_INTERVAL
+from utils.llm_scheduler import llm_scheduler, PRIORITY_CHAT, PRIORITY_BULK
+from utils.llm_cache import LLMCache
+from utils.model_registry import model_registry
+from utils.prompt_budget import estimate_tokens, REDUCTION_STRATEGIES, prompt_size_log
+from app_constants import MAP_REDUCE_CHUNK_TOKENS, MAP_REDUCE_TARGET_TOKENS, MAP_REDUCE_MAX_LEVELS
+from app_constants import ANALYSIS_TIME_RESERVE, FAST_MODEL_BELOW_SECONDS, FAST_ANALYSIS_MODEL, ANALYSIS_MODEL, ANALYSIS_SAFETY_SETTINGS
+from app_constants import LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES, LLM_CACHE_TTL
+from app_constants import PROMPT_TOKEN_BUDGETS, DEFAULT_PROMPT_TOKEN_BUDGET, PROMPT_COUNT_WITH_API, PROMPT_OUTPUT_RESERVE
+from app_constants import TOOL_TIMEOUT, MAX_TOOL_RESULT_CHARS, MAX_FUNCTION_ROUND_TRIPS
+from app_constants import HISTORY_COMPACT_TOKENS, HISTORY_KEEP_RECENT_TOKENS, HISTORY_FUNCTION_RESPONSE_CHARS, HISTORY_SUMMARY_MODEL
+from app_constants import OUTPUT_ROOT, RESPONSE
 
 import os
 load_dotenv()
-genai.configure(api_key=os.environ["API_KEY"])
+
+# Shared by every agent and session, identical prompts are answered from disk
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES, LLM_CACHE_TTL)
+# (agent, cancel token) of the tool call running in the current thread or task, see AgentBase.cancel_token
+current_tool_call = contextvars.ContextVar('current_tool_call', default=None)
+
+class AnalysisError(Exception):
+    """
+    An analysis couldn't be generated (the call failed or the answer was blocked).
+    """
+    pass
+
 
 class AgentBase(ABC):
+    # Agents that implement agenerate_response natively set this to True, their tools are awaited on the event loop
+    # (see aexecute_function_sequence).
+    async_native = False
+    # Seconds each tool call may run before the model is told it timed out. None waits as long as it takes.
+    # tool_timeouts overrides it per function name
+    tool_timeout = TOOL_TIMEOUT
+    tool_timeouts = {}
+    # Whether the function calls of one model turn run at the same time. Agents whose tools share state set it to False
+    parallel_tools = True
+    # Seconds a delegated result stays fresh in the manager's result cache. 0 disables caching for the agent
+    cache_ttl = 600
+    # Priority of this agent's analysis calls in the LLM scheduler
+    analysis_priority = PRIORITY_BULK
+    # Safety settings for analysis calls, agents analysing sensitive content can tighten them
+    analysis_safety_settings = ANALYSIS_SAFETY_SETTINGS
+
     def __init__(self):
         self.model = None
         self.chat = None
         self.first_conversation = True
+        # Set by the manager for each run, see check_cancelled() and remaining_time()
+        self.cancel_token = None
+        self.deadline = None
+        # (function name, event set once it exited) of tool calls that were told to stop after their timeout,
+        # see wait_for_abandoned_calls()
+        self.abandoned_calls = []
+        # Called with (agent, text) for every piece of a streamed analysis, see pro_generate_analysis()
+        self.stream_callback = None
+        # Why the current run's result is partial (work cut to fit the deadline, failed analyses or tools).
+        # Reset by the manager for each run, partial results aren't cached
+        self.degraded_reasons = []
+        # Set by the manager to its session's folder and socket room, so sessions never see each other's reports
+        # or debug messages. Debug messages are broadcast when debug_room is None
+        self.output_root = OUTPUT_ROOT
+        self.debug_room = None
         self.set_model() 
 
     @abstractmethod
     def generate_response(self, prompt: str) -> str:
         pass
 
+    async def agenerate_response(self, prompt: str) -> str:
+        """
+        Async version of generate_response. Agents that only implement the blocking generate_response
+        (including generated g_* agents) are run on a worker thread so they never block the event loop.
+        """
+        return await asyncio.to_thread(self.generate_response, prompt)
+
     @abstractmethod
     def get_functions(self):
         pass
 
     def set_model(self):
         functions = self.get_functions()
-        self.model = genai.GenerativeModel(model_name='gemini-1.0-pro', tools=functions.values())
-        self.chat = self.model.start_chat(enable_automatic_function_calling=True)
+        # Function calls are run by execute_function_sequence on this instance's functions, the model only declares
+        # the tools, so it is shared by every instance of the agent
+        self.model = model_registry.get('gemini-1.0-pro', functions.values())
+        self.chat = self.model.start_chat()
+
+    def reset(self):
+        """
+        Start a new chat with an empty history, reusing the existing model. Called when a cached agent
+        instance is reused for a new request.
+        """
+        self.chat = self.model.start_chat()
+        self.first_conversation = True
+
+    def get_output_folder(self):
+        """
+        Folder this agent writes its report and data to, <output root>/<agent key>. Created if needed.
+        """
+        output_folder = f"{self.output_root}/{type(self).__module__.split('.')[-1]}"
+        os.makedirs(output_folder, exist_ok=True)
+        return output_folder
+
+    def get_response_path(self):
+        return f"{self.get_output_folder()}/{RESPONSE}"
     
     def emit_debug_message(self, emit_message, agent_name, ):
         # try catch block to prevent the server from crashing if the socketio connection is not established
         try:
-            socketio.emit('debug', {'message': emit_message, 'agent': agent_name})
+            if self.debug_room is not None:
+                socketio.emit('debug', {'message': emit_message, 'agent': agent_name}, to=self.debug_room)
+            else:
+                socketio.emit('debug', {'message': emit_message, 'agent': agent_name})
         except Exception as e:
             print(f"Error emitting debug message: {e}")
             logging.error(f"Error emitting debug message: {e}")
             return
     
+    @property
+    def cancel_token(self):
+        """
+        The token of the current run. Inside a tool call it is the call's own token, a child of the run's token
+        that is also cancelled when the call times out.
+        """
+        tool_call = current_tool_call.get()
+        if tool_call is not None and tool_call[0] is self:
+            return tool_call[1]
+        return self.run_cancel_token
+
+    @cancel_token.setter
+    def cancel_token(self, cancel_token):
+        self.run_cancel_token = cancel_token
+
+    def check_cancelled(self):
+        """
+        Raise TaskCancelled if the request this agent is working on was cancelled. Call it between steps of long fetch loops.
+        """
+        if self.cancel_token is not None:
+            self.cancel_token.raise_if_cancelled()
+
+    def remaining_time(self):
+        """
+        Seconds left before this run's deadline, or None if the request has no deadline.
+        """
+        return self.deadline.remaining() if self.deadline is not None else None
+
+    def fit_to_budget(self, requested: int, seconds_per_item: float, reserve: float = ANALYSIS_TIME_RESERVE, minimum: int = 1) -> int:
+        """
+        How many items (posts, pages, reviews...) fit in the time left, keeping `reserve` seconds for the analysis.
+
+        Args:
+            requested: number of items asked for.
+            seconds_per_item: rough time it takes to process one item.
+            reserve: seconds to keep free for the work that follows.
+            minimum: always process at least this many, so there is something to report.
+
+        Returns:
+            int: requested, or fewer if they don't fit.
+        """
+        remaining = self.remaining_time()
+        if remaining is None:
+            return requested
+        fitted = max(minimum, min(requested, int((remaining - reserve) / seconds_per_item)))
+        if fitted < requested:
+            print(f"{type(self).__name__}: {remaining:.0f}s left, processing {fitted} of {requested} items.")
+            self.mark_degraded(f"processed {fitted} of {requested} items")
+        return fitted
+
+    def mark_degraded(self, reason):
+        """
+        Record that the current run's result is partial, so it isn't reused from the result cache.
+        """
+        self.degraded_reasons.append(reason)
+
+    def analysis_model_name(self):
+        """
+        The model used for analyses, the faster one when the deadline is close.
+        """
+        remaining = self.remaining_time()
+        if remaining is not None and remaining < FAST_MODEL_BELOW_SECONDS:
+            print(f"{type(self).__name__}: {remaining:.0f}s left, using {FAST_ANALYSIS_MODEL}.")
+            self.mark_degraded(f"analysed with {FAST_ANALYSIS_MODEL}")
+            return FAST_ANALYSIS_MODEL
+        return ANALYSIS_MODEL
+
+    async def await_cancellable(self, awaitable):
+        """
+        Await something on the event loop, cancelling it as soon as the request is cancelled.
+        """
+        task = asyncio.ensure_future(awaitable)
+        if self.cancel_token is None:
+            return await task
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=CANCEL_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if self.cancel_token.cancelled:
+                task.cancel()
+                raise TaskCancelled(self.cancel_token.reason)
+
+    def chat_tokens(self, chat, content):
+        # Every turn sends the whole history along with the new content
+        return self.estimate_tokens(str(content)) + sum(self.estimate_tokens(str(message)) for message in chat.history)
+
+    @staticmethod
+    def is_user_prompt(content):
+        # A turn starts with a user message with text, function responses are sent with the user role too
+        return content.role == 'user' and any(part.text for part in content.parts)
+
+    @staticmethod
+    def shorten_function_responses(content):
+        """
+        Copy of content with long function responses cut to HISTORY_FUNCTION_RESPONSE_CHARS.
+        """
+        parts = []
+        for part in content.parts:
+            if part.function_response:
+                response = type(part.function_response).to_dict(part.function_response).get('response', {})
+                result = json.dumps(response.get('result', response), default=str)
+                if len(result) > HISTORY_FUNCTION_RESPONSE_CHARS:
+                    s = Struct()
+                    s.update({'result': f"{result[:HISTORY_FUNCTION_RESPONSE_CHARS]} [older result truncated]"})
+                    part = glm.Part(function_response=glm.FunctionResponse(name=part.function_response.name, response=s))
+            parts.append(part)
+        return glm.Content(role=content.role, parts=parts)
+
+    @staticmethod
+    def describe_content(content):
+        lines = []
+        for part in content.parts:
+            if part.text:
+                lines.append(f"{content.role}: {part.text}")
+            elif part.function_call:
+                arguments = type(part.function_call).to_dict(part.function_call).get('args', {})
+                lines.append(f"{content.role} called {part.function_call.name}({json.dumps(arguments, default=str)})")
+            elif part.function_response:
+                response = type(part.function_response).to_dict(part.function_response).get('response', {})
+                lines.append(f"{part.function_response.name} returned: {json.dumps(response, default=str)[:HISTORY_FUNCTION_RESPONSE_CHARS]}")
+        return "\n".join(lines)
+
+    def compact_history(self, chat):
+        """
+        Keep the cost of every turn flat in long sessions: once the chat history is over HISTORY_COMPACT_TOKENS,
+        the older turns are replaced by a rolling summary and long function responses in the recent turns are cut.
+        Called before a new prompt is sent, so a function call is never separated from its response.
+        """
+        history = list(chat.history)
+        if sum(self.estimate_tokens(str(content)) for content in history) <= HISTORY_COMPACT_TOKENS:
+            return
+
+        recent = [self.shorten_function_responses(content) for content in history]
+        # Keep the most recent whole turns that fit in HISTORY_KEEP_RECENT_TOKENS, and at least the last turn
+        turn_starts = [index for index, content in enumerate(recent) if self.is_user_prompt(content)]
+        split = turn_starts[-1] if turn_starts else len(recent)
+        for index in reversed(turn_starts):
+            if sum(self.estimate_tokens(str(content)) for content in recent[index:]) > HISTORY_KEEP_RECENT_TOKENS:
+                break
+            split = index
+        older, recent = history[:split], recent[split:]
+
+        if older:
+            # The previous summary is the first message of the older part, so it is rolled into the new one
+            transcript = "\n".join(self.describe_content(content) for content in older)
+            prompt = f"""
+                Summarize this conversation between a user, an AI assistant and the tools it called.
+                Keep every fact, number, name, file path and decision the assistant may need to answer follow-up questions.
+                Write it as a concise list, without an introduction.
+
+                {transcript}
+            """
+            try:
+                summary = self.generate_text(HISTORY_SUMMARY_MODEL, prompt)
+            except Exception as e:
+                logging.error(f"Summarizing the chat history failed: {e}")
+                return
+            recent = [
+                glm.Content(role='user', parts=[glm.Part(text=f"Summary of the conversation so far:\n{summary}")]),
+                glm.Content(role='model', parts=[glm.Part(text="Understood, I'll use this summary as context.")])
+            ] + recent
+
+        before = sum(self.estimate_tokens(str(content)) for content in history)
+        chat.history = recent
+        after = sum(self.estimate_tokens(str(content)) for content in recent)
+        print(f"{type(self).__name__}: Compacted chat history from {before} to {after} tokens.")
+
+    def send_chat_message(self, model, chat, content):
+        return llm_scheduler.call(model.model_name, self.chat_tokens(chat, content), PRIORITY_CHAT, self.cancel_token,
+                                  call_cancellable, self.cancel_token, chat.send_message, content)
+
+    async def asend_chat_message(self, model, chat, content):
+        return await self.await_cancellable(llm_scheduler.acall(
+            model.model_name, self.chat_tokens(chat, content), PRIORITY_CHAT, self.cancel_token, chat.send_message_async, content))
+
+    @staticmethod
+    def get_function_calls(response):
+        return [part.function_call for part in response.candidates[0].content.parts if part.function_call]
+
+    @staticmethod
+    def get_response_text(response):
+        try:
+            return response.text
+        except ValueError:
+            # No text part, e.g. the answer was blocked
+            return "The model did not return a response."
+
+    def get_tool_timeout(self, function_name):
+        return self.tool_timeouts.get(function_name, self.tool_timeout)
+
+    def cap_tool_result(self, function_name, result):
+        """
+        Make a tool result safe to send back: plain values are kept, anything else becomes a string,
+        and results longer than MAX_TOOL_RESULT_CHARS are cut so one tool can't blow up the chat history.
+        """
+        if result is not None and not isinstance(result, (str, int, float, bool, list, dict)):
+            result = str(result)
+        if isinstance(result, (list, dict)) and len(json.dumps(result, default=str)) > MAX_TOOL_RESULT_CHARS:
+            result = json.dumps(result, default=str)
+        if isinstance(result, str) and len(result) > MAX_TOOL_RESULT_CHARS:
+            print(f"{type(self).__name__}: Result of {function_name} cut from {len(result)} to {MAX_TOOL_RESULT_CHARS} characters.")
+            result = f"{result[:MAX_TOOL_RESULT_CHARS]}\n\n[Result truncated, {len(result) - MAX_TOOL_RESULT_CHARS} more characters]"
+        return result
+
+    @staticmethod
+    def build_function_responses(function_calls, results):
+        function_responses = []
+        for function_call, result in zip(function_calls, results):
+            s = Struct()
+            s.update({'result': result})
+            function_responses.append(glm.Part(function_response=glm.FunctionResponse(name=function_call.name, response=s)))
+        return function_responses
+
+    def call_function(self, functions, function_call):
+        function_name = function_call.name
+        if function_name not in functions:
+            return f"Error: unknown function {function_name}"
+        function_args = type(function_call).to_dict(function_call).get('args', {}) or {}
+        try:
+            return functions[function_name](**function_args)
+        except Exception as e:
+            logging.error(f"Function {function_name} failed: {e}")
+            self.mark_degraded(f"{function_name} failed")
+            return f"Error: {e}"
+
+    def new_tool_call(self):
+        """
+        Returns:
+            tuple: (cancel token for one tool call, event set once the call has exited)
+        """
+        cancel_token = self.run_cancel_token.child() if self.run_cancel_token is not None else CancelToken()
+        return cancel_token, threading.Event()
+
+    def run_tool(self, cancel_token, finished, function, *args, **kwargs):
+        # Runs a blocking tool on a worker thread, where self.cancel_token is the call's own token
+        context_token = current_tool_call.set((self, cancel_token))
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_tool_call.reset(context_token)
+            finished.set()
+
+    def abandon_tool_call(self, function_name, cancel_token, finished):
+        # The call stops at its next cancellation check, the agent waits for it before its next tool call or run
+        cancel_token.cancel(f"{function_name} timed out")
+        if not finished.is_set():
+            self.abandoned_calls.append((function_name, finished))
+
+    def wait_for_abandoned_calls(self):
+        """
+        Block until the tool calls abandoned after their timeout have exited, so they can't overwrite the
+        report or data of a later call. They were cancelled, so this is usually short.
+        """
+        while self.abandoned_calls:
+            function_name, finished = self.abandoned_calls[0]
+            if not finished.is_set():
+                print(f"{type(self).__name__}: Waiting for {function_name}, which timed out, to stop.")
+            while not finished.wait(CANCEL_POLL_INTERVAL):
+                self.check_cancelled()
+            self.abandoned_calls.pop(0)
+
+    def call_functions(self, functions, function_calls):
+        """
+        Run all function calls of one model turn at the same time, each with its own timeout. Without parallel_tools
+        they run one after another.
+
+        Returns:
+            list: one result per function call, in order.
+        """
+        if not self.parallel_tools and len(function_calls) > 1:
+            return [result for function_call in function_calls for result in self.call_functions(functions, [function_call])]
+        self.wait_for_abandoned_calls()
+        if len(function_calls) == 1 and self.get_tool_timeout(function_calls[0].name) is None:
+            return [self.call_function(functions, function_calls[0])]
+
+        executor = ThreadPoolExecutor(max_workers=len(function_calls), thread_name_prefix="tool")
+        tool_calls = [self.new_tool_call() for _ in function_calls]
+        futures = [executor.submit(self.run_tool, cancel_token, finished, self.call_function, functions, function_call)
+                   for function_call, (cancel_token, finished) in zip(function_calls, tool_calls)]
+        started_at = time.monotonic()
+        deadlines = [started_at + timeout if timeout is not None else None
+                     for timeout in (self.get_tool_timeout(function_call.name) for function_call in function_calls)]
+        try:
+            # Wake up regularly so a cancelled request stops waiting right away
+            while True:
+                self.check_cancelled()
+                now = time.monotonic()
+                running = [future for future, deadline in zip(futures, deadlines) if not future.done() and (deadline is None or now < deadline)]
+                if not running:
+                    break
+                wait(running, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        finally:
+            executor.shutdown(wait=False)
+            # Calls still running after their timeout are told to stop, their results are dropped
+            for function_call, future, (cancel_token, finished) in zip(function_calls, futures, tool_calls):
+                if not future.done():
+                    self.abandon_tool_call(function_call.name, cancel_token, finished)
+
+        results = []
+        for function_call, future in zip(function_calls, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                logging.error(f"Function {function_call.name} timed out")
+                self.mark_degraded(f"{function_call.name} timed out")
+                results.append(f"Error: {function_call.name} did not finish within {self.get_tool_timeout(function_call.name)} seconds.")
+        return results
+
     def execute_function_sequence(self, model, functions, prompt, chat):
+        """
+        Send prompt to the chat and run the function calls the model asks for until it answers with text.
+        All calls of one turn run at the same time (unless parallel_tools is False), and at most MAX_FUNCTION_ROUND_TRIPS turns of calls are made.
+        """
         self.first_conversation = False
         logging.debug(f"Generating response using the following prompt:\n{prompt}")
-        response = chat.send_message(prompt)
+        self.compact_history(chat)
+        response = self.send_chat_message(model, chat, prompt)
+
+        for round_trip in range(MAX_FUNCTION_ROUND_TRIPS + 1):
+            function_calls = self.get_function_calls(response)
+            if not function_calls:
+                break
+            if round_trip == MAX_FUNCTION_ROUND_TRIPS:
+                print(f"{type(self).__name__}: Stopped after {MAX_FUNCTION_ROUND_TRIPS} rounds of function calls.")
+                results = ["Error: too many function calls, answer with the information you already have."] * len(function_calls)
+            else:
+                print(f"{type(self).__name__}: Calling {', '.join(function_call.name for function_call in function_calls)}")
+                results = self.call_functions(functions, function_calls)
+            results = [self.cap_tool_result(function_call.name, result) for function_call, result in zip(function_calls, results)]
+            response = self.send_chat_message(model, chat, self.build_function_responses(function_calls, results))
+
         logging.debug(f"CHAT HISTORY:\n{chat.history}")
         logging.debug(f"DEBUG: response: \n\n{response}")
-        
-        if response.text:
-            return response.text
-        else:
-            return response.result.candidates[0].content.parts[0].text
+        return self.get_response_text(response)
 
-    
-    def pro_generate_analysis(self, summary_prompt):
-        model = genai.GenerativeModel('gemini-1.5-pro-latest')
-        response = model.generate_content(summary_prompt)
-        print(response)
-        
+    async def aexecute_function_sequence(self, model, functions, prompt, chat):
+        """
+        Async version of execute_function_sequence for async_native agents: coroutine tools are awaited,
+        blocking tools run on a worker thread.
+        """
+        self.first_conversation = False
+        logging.debug(f"Generating response using the following prompt:\n{prompt}")
+        await self.await_cancellable(asyncio.to_thread(self.compact_history, chat))
+        response = await self.asend_chat_message(model, chat, prompt)
+
+        for round_trip in range(MAX_FUNCTION_ROUND_TRIPS + 1):
+            function_calls = self.get_function_calls(response)
+            if not function_calls:
+                break
+            if round_trip == MAX_FUNCTION_ROUND_TRIPS:
+                print(f"{type(self).__name__}: Stopped after {MAX_FUNCTION_ROUND_TRIPS} rounds of function calls.")
+                results = ["Error: too many function calls, answer with the information you already have."] * len(function_calls)
+            else:
+                print(f"{type(self).__name__}: Calling {', '.join(function_call.name for function_call in function_calls)}")
+                await asyncio.to_thread(self.wait_for_abandoned_calls)
+                if self.parallel_tools:
+                    results = await asyncio.gather(*(self.acall_function(functions, function_call) for function_call in function_calls))
+                else:
+                    results = [await self.acall_function(functions, function_call) for function_call in function_calls]
+            results = [self.cap_tool_result(function_call.name, result) for function_call, result in zip(function_calls, results)]
+            response = await self.asend_chat_message(model, chat, self.build_function_responses(function_calls, results))
+
+        logging.debug(f"CHAT HISTORY:\n{chat.history}")
+        logging.debug(f"DEBUG: response: \n\n{response}")
+        return self.get_response_text(response)
+
+    async def acall_function(self, functions, function_call):
+        function_name = function_call.name
+        if function_name not in functions:
+            return f"Error: unknown function {function_name}"
+        function_args = type(function_call).to_dict(function_call).get('args', {}) or {}
+        function = functions[function_name]
+        # Each call runs in its own task, so the call's token is only seen by this call
+        cancel_token, finished = self.new_tool_call()
+        context_token = current_tool_call.set((self, cancel_token))
         try:
-            response = model.generate_content(
+            if inspect.iscoroutinefunction(function):
+                # A timed out coroutine is cancelled by wait_for and has exited when it returns
+                finished.set()
+                call = function(**function_args)
+            else:
+                call = asyncio.to_thread(self.run_tool, cancel_token, finished, function, **function_args)
+            return await asyncio.wait_for(call, self.get_tool_timeout(function_name))
+        except asyncio.TimeoutError:
+            logging.error(f"Function {function_name} timed out")
+            self.mark_degraded(f"{function_name} timed out")
+            return f"Error: {function_name} did not finish within {self.get_tool_timeout(function_name)} seconds."
+        except Exception as e:
+            logging.error(f"Function {function_name} failed: {e}")
+            self.mark_degraded(f"{function_name} failed")
+            return f"Error: {e}"
+        finally:
+            current_tool_call.reset(context_token)
+            # A blocking tool still running after its timeout, or when the request was cancelled, is told to stop
+            if not finished.is_set():
+                self.abandon_tool_call(function_name, cancel_token, finished)
+
+    def get_analysis_model(self, model_name):
+        """
+        The GenerativeModel for analyses with model_name, shared by every agent.
+        """
+        return model_registry.get(model_name)
+
+    def read_analysis_response(self, response):
+        """
+        Read an analysis response.
+
+        Returns:
+            tuple: (the analysis, or an error message if the prompt or the answer was blocked, whether it succeeded)
+        """
+        if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
+            print("Prompt was blocked due to the following reason:", response.prompt_feedback.block_reason)
+            return "Unable to generate analysis due to content restrictions.", False
+
+        if response.candidates and response.candidates[0].finish_reason == glm.Candidate.FinishReason.SAFETY:
+            print("Analysis was blocked due to the following ratings:", response.candidates[0].safety_ratings)
+            return "Unable to generate analysis due to content restrictions.", False
+
+        if response.candidates and response.text:
+            return response.text, True
+        print("No useful response was generated. Review the input or model configuration.")
+        return "An error occurred during analysis.", False
+
+    def stream_analysis_text(self, text, report_file):
+        """
+        Append a streamed piece of an analysis to the report file and forward it to the client.
+        """
+        report_file.write(text)
+        report_file.flush()
+        if self.stream_callback is not None:
+            try:
+                self.stream_callback(type(self).__module__.split('.')[-1], text)
+            except Exception as e:
+                logging.error(f"Error streaming analysis: {e}")
+
+    @staticmethod
+    def chunk_text(chunk):
+        try:
+            return chunk.text
+        except ValueError:
+            # A chunk without text, e.g. the final chunk of a blocked answer
+            return ""
+
+    def get_cached_analysis(self, cache_key, report_path):
+        """
+        Return a cached analysis, or None. A cached analysis is streamed in one piece so the client sees it like a generated one.
+        """
+        analysis = llm_cache.get(cache_key)
+        if analysis is None:
+            return None
+        print(f"{type(self).__name__}: LLM CACHE HIT, reusing an identical analysis.")
+        if report_path is not None:
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+            with open(report_path, 'w', encoding='utf-8') as report_file:
+                self.stream_analysis_text(analysis, report_file)
+        return analysis
+
+    def pro_generate_analysis(self, summary_prompt, report_path=None, raise_errors=False):
+        """
+        Generate an analysis with a single call to the analysis model. Identical prompts are answered from the LLM cache.
+
+        Args:
+            summary_prompt: the analysis prompt.
+            report_path: if set, the analysis is streamed: every piece is appended to this file and sent to
+                stream_callback as it arrives. The caller still writes the returned text once it is complete.
+            raise_errors: raise AnalysisError instead of returning an error message if the analysis fails.
+
+        Returns:
+            str: the analysis, or an error message if it couldn't be generated.
+        """
+        self.check_cancelled()
+        model_name = self.analysis_model_name()
+        cache_key = LLMCache.make_key(model_name, self.analysis_safety_settings, summary_prompt)
+        analysis = self.get_cached_analysis(cache_key, report_path)
+        if analysis is not None:
+            return analysis
+
+        model = self.get_analysis_model(model_name)
+        try:
+            response = llm_scheduler.call(
+                model_name,
+                self.estimate_tokens(summary_prompt),
+                self.analysis_priority,
+                self.cancel_token,
+                call_cancellable,
+                self.cancel_token,
+                model.generate_content,
                 summary_prompt,
-                safety_settings={
-                    'HATE': 'BLOCK_NONE',
-                    'HARASSMENT': 'BLOCK_NONE',
-                    'SEXUAL': 'BLOCK_NONE',
-                    'DANGEROUS': 'BLOCK_NONE'
-                }
+                safety_settings=self.analysis_safety_settings,
+                stream=report_path is not None
             )
+            if report_path is not None:
+                os.makedirs(os.path.dirname(report_path), exist_ok=True)
+                with open(report_path, 'w', encoding='utf-8') as report_file:
+                    for chunk in response:
+                        self.check_cancelled()
+                        self.stream_analysis_text(self.chunk_text(chunk), report_file)
+            analysis, succeeded = self.read_analysis_response(response)
+        except Exception as e:
+            print(f"{type(self).__name__}: An unexpected error occurred during analysis:", str(e))
+            if raise_errors:
+                raise AnalysisError(str(e)) from e
+            self.mark_degraded("analysis failed")
+            return "Failed to generate analysis due to an error."
 
-            if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-                print("Prompt was blocked due to the following reason:", response.prompt_feedback.block_reason)
-                return "Unable to generate analysis due to content restrictions."
+        if succeeded:
+            llm_cache.put(cache_key, analysis)
+        elif raise_errors:
+            raise AnalysisError(analysis)
+        else:
+            self.mark_degraded("analysis blocked")
+        return analysis
 
-            if response.text:
-                analysis_text = response.text
- 
-                return analysis_text
-            else:
-                print("No useful response was generated. Review the input or model configuration.")
-                return "An error occurred during analysis."
+    async def apro_generate_analysis(self, summary_prompt, report_path=None, raise_errors=False):
+        """
+        Async version of pro_generate_analysis, used by async_native agents. With raise_errors, a failed
+        analysis raises AnalysisError instead of returning an error message.
+        """
+        self.check_cancelled()
+        model_name = self.analysis_model_name()
+        cache_key = LLMCache.make_key(model_name, self.analysis_safety_settings, summary_prompt)
+        analysis = self.get_cached_analysis(cache_key, report_path)
+        if analysis is not None:
+            return analysis
+
+        model = self.get_analysis_model(model_name)
+        try:
+            response = await self.await_cancellable(llm_scheduler.acall(
+                model_name,
+                self.estimate_tokens(summary_prompt),
+                self.analysis_priority,
+                self.cancel_token,
+                model.generate_content_async,
+                summary_prompt,
+                safety_settings=self.analysis_safety_settings,
+                stream=report_path is not None
+            ))
+            if report_path is not None:
+                os.makedirs(os.path.dirname(report_path), exist_ok=True)
+                with open(report_path, 'w', encoding='utf-8') as report_file:
+                    async for chunk in response:
+                        self.check_cancelled()
+                        self.stream_analysis_text(self.chunk_text(chunk), report_file)
+            analysis, succeeded = self.read_analysis_response(response)
+        except Exception as e:
+            print(f"{type(self).__name__}: An unexpected error occurred during analysis:", str(e))
+            if raise_errors:
+                raise AnalysisError(str(e)) from e
+            self.mark_degraded("analysis failed")
+            return "Failed to generate analysis due to an error."
+
+        if succeeded:
+            llm_cache.put(cache_key, analysis)
+        elif raise_errors:
+            raise AnalysisError(analysis)
+        else:
+            self.mark_degraded("analysis blocked")
+        return analysis
+
+    def generate_text(self, model_name, prompt, ttl=None):
+        """
+        One-off generation outside the agent's chat (e.g. clarifying a title), scheduled and cached like analyses.
+
+        Args:
+            model_name: the model to use.
+            prompt: the prompt.
+            ttl: seconds a cached answer stays fresh, LLM_CACHE_TTL by default.
+
+        Returns:
+            str: the generated text.
+        """
+        cache_key = LLMCache.make_key(model_name, None, prompt)
+        text = llm_cache.get(cache_key, ttl)
+        if text is not None:
+            return text
+        response = llm_scheduler.call(model_name, self.estimate_tokens(prompt), PRIORITY_CHAT, self.cancel_token,
+                                      call_cancellable, self.cancel_token, self.get_analysis_model(model_name).generate_content, prompt)
+        text = response.text
+        llm_cache.put(cache_key, text)
+        return text
 
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return estimate_tokens(text)
+
+    def count_tokens(self, model_name, text, budget):
+        """
+        Tokens in text. Estimated locally, and counted by the API when the estimate is close enough to the budget to matter.
+        """
+        estimate = estimate_tokens(text)
+        if not PROMPT_COUNT_WITH_API or not budget * 0.8 <= estimate <= budget * 1.5:
+            return estimate
+        try:
+            return call_cancellable(self.cancel_token, self.get_analysis_model(model_name).count_tokens, text).total_tokens
         except Exception as e:
-            print("An unexpected error occurred:", str(e))
-            print("REDDIT AGENT: Task completed with error.")
-            return "Failed to generate analysis due to an error."
\ No newline at end of file
+            logging.warning(f"Counting tokens failed, using the estimate: {e}")
+            return estimate
+
+    @staticmethod
+    def prompt_token_budget(model_name):
+        """
+        Maximum prompt tokens for model_name. A prompt larger than the model's tokens-per-minute limit would
+        hold back every other call to the model in the LLM scheduler, so the budget is capped below it.
+        """
+        model_name = model_name.split('/')[-1]
+        budget = PROMPT_TOKEN_BUDGETS.get(model_name, DEFAULT_PROMPT_TOKEN_BUDGET)
+        return min(budget, llm_scheduler.tokens_per_minute(model_name) - PROMPT_OUTPUT_RESERVE)
+
+    def analysis_token_budget(self):
+        # Fits whichever analysis model is picked when the call is made
+        return min(self.prompt_token_budget(ANALYSIS_MODEL), self.prompt_token_budget(FAST_ANALYSIS_MODEL))
+
+    def fit_prompt(self, build_prompt, items, instruction, strategy='truncate', model_name=None):
+        """
+        Build a prompt from a list of items (reviews, posts, pages...) that fits the model's prompt budget,
+        reducing the items with a strategy if it doesn't. The original and sent sizes are recorded in prompt_size_log.
+
+        Args:
+            build_prompt: build_prompt(items) -> prompt.
+            items (list[str]): the items the prompt is built from.
+            instruction (str): what the prompt asks for, used by the summarize strategy.
+            strategy: 'truncate', 'sample', 'summarize' (see utils/prompt_budget.py) or a function with the same signature.
+            model_name: model the prompt is for, the analysis model by default.
+
+        Returns:
+            str: the prompt.
+        """
+        model_name = model_name or self.analysis_model_name()
+        budget = self.prompt_token_budget(model_name)
+        items = [str(item) for item in items]
+        prompt = build_prompt(items)
+        original_tokens = self.count_tokens(model_name, prompt, budget)
+        sent_items = items
+        sent_tokens = original_tokens
+
+        if original_tokens > budget:
+            reduce = REDUCTION_STRATEGIES[strategy] if isinstance(strategy, str) else strategy
+            item_budget = budget - estimate_tokens(build_prompt([]))
+            for attempt in range(2):
+                sent_items = reduce(self, items, instruction, item_budget)
+                prompt = build_prompt(sent_items)
+                sent_tokens = self.count_tokens(model_name, prompt, budget)
+                if sent_tokens <= budget:
+                    break
+                # The estimate was too optimistic, shrink by the overshoot and try again
+                item_budget = int(item_budget * budget / sent_tokens)
+            print(f"{type(self).__name__}: PROMPT BUDGET {budget} tokens, reduced {original_tokens} to {sent_tokens} tokens with {getattr(reduce, '__name__', strategy)}.")
+            self.emit_debug_message(f"**{type(self).__name__}:** The data is too large for one prompt, sending {sent_tokens} of {original_tokens} tokens.", type(self).__name__)
+
+        prompt_size_log.record(type(self).__name__, model_name, strategy if isinstance(strategy, str) else strategy.__name__,
+                               original_tokens, sent_tokens, len(items), len(sent_items))
+        return prompt
+
+    async def afit_prompt(self, build_prompt, items, instruction, strategy='truncate', model_name=None):
+        """
+        Async version of fit_prompt. Runs on a worker thread, token counting and the summarize strategy block.
+        """
+        return await self.await_cancellable(asyncio.to_thread(self.fit_prompt, build_prompt, items, instruction, strategy, model_name))
+
+    @staticmethod
+    def split_into_chunks(texts, chunk_tokens):
+        """
+        Pack texts into chunks of at most chunk_tokens (estimated). Texts longer than a chunk are split,
+        preferably on a line break.
+        """
+        max_chars = chunk_tokens * 4
+        pieces = []
+        for text in texts:
+            while len(text) > max_chars:
+                cut = text.rfind("\n", max_chars // 2, max_chars)
+                cut = cut if cut != -1 else max_chars
+                pieces.append(text[:cut])
+                text = text[cut:]
+            if text.strip():
+                pieces.append(text)
+
+        chunks = []
+        current = ""
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def amap_reduce_summarize(self, texts, instruction, chunk_tokens=MAP_REDUCE_CHUNK_TOKENS, target_tokens=MAP_REDUCE_TARGET_TOKENS):
+        """
+        Condense texts of any size until they fit in target_tokens. Texts are split into chunks of chunk_tokens,
+        every chunk is summarized at the same time, and the summaries are reduced again level by level.
+
+        Args:
+            texts (list[str]): the texts to condense, e.g. reviews, articles or agent reports.
+            instruction (str): what the final analysis is about, so the summaries keep the relevant details.
+            chunk_tokens (int): maximum estimated tokens sent in each summary call.
+            target_tokens (int): the condensed result is at most this many estimated tokens.
+
+        Returns:
+            str: the condensed text. Returned unchanged if it already fits. Chunks that fail are left out.
+
+        Raises:
+            AnalysisError: every chunk of a level failed.
+        """
+        texts = [str(text) for text in texts if text]
+        # Leave room for the summary instructions around each chunk
+        chunk_tokens = min(chunk_tokens, self.analysis_token_budget() - self.estimate_tokens(instruction) - 500)
+        level = 0
+        while sum(self.estimate_tokens(text) for text in texts) > target_tokens:
+            if level >= MAP_REDUCE_MAX_LEVELS:
+                # Bound the latency, keep the start of every summary
+                per_text_chars = target_tokens * 4 // max(len(texts), 1)
+                texts = [text[:per_text_chars] for text in texts]
+                break
+            level += 1
+            chunks = self.split_into_chunks(texts, chunk_tokens)
+            print(f"MAP REDUCE: Level {level}, summarizing {len(chunks)} chunks...")
+            summaries = await asyncio.gather(*(self.asummarize_chunk(chunk, instruction, index, len(chunks)) for index, chunk in enumerate(chunks)),
+                                             return_exceptions=True)
+            for summary in summaries:
+                if isinstance(summary, BaseException) and not isinstance(summary, AnalysisError):
+                    raise summary
+            failed = sum(1 for summary in summaries if isinstance(summary, AnalysisError))
+            if failed == len(chunks):
+                raise AnalysisError(f"All {len(chunks)} chunk summaries failed.")
+            if failed:
+                # Error text would otherwise be summarized as if it were content
+                print(f"MAP REDUCE: Dropped {failed} of {len(chunks)} chunks that couldn't be summarized.")
+                self.emit_debug_message(f"**{type(self).__name__}:** {failed} of {len(chunks)} parts couldn't be summarized and were left out.", type(self).__name__)
+                self.mark_degraded(f"dropped {failed} of {len(chunks)} chunks")
+            texts = [summary for summary in summaries if summary and not isinstance(summary, AnalysisError)]
+        return "\n\n".join(texts)
+
+    def map_reduce_summarize(self, texts, instruction, chunk_tokens=MAP_REDUCE_CHUNK_TOKENS, target_tokens=MAP_REDUCE_TARGET_TOKENS):
+        """
+        Blocking version of amap_reduce_summarize for agents that run on worker threads.
+        """
+        return run_sync(self.amap_reduce_summarize(texts, instruction, chunk_tokens, target_tokens))
+
+    async def asummarize_chunk(self, chunk, instruction, index, chunk_count):
+        prompt = f"""
+            This is part {index + 1} of {chunk_count} of a larger body of text that will be analysed with this instruction:
+
+            {instruction}
+
+            Summarize this part in detail, keeping every fact, number, opinion and quote that is relevant to the instruction.
+            Do not write an introduction or a conclusion.
+
+            {chunk}
+        """
+        return await self.apro_generate_analysis(prompt, raise_errors=True)
@@ -2,25 +2,24 @@
 import os
 from dotenv import load_dotenv
 from agents.agent_base import AgentBase
-import google.generativeai as genai
 from utils.file import File
-from app_constants import RESPONSE
+from utils.llm_scheduler import llm_scheduler, PRIORITY_CHAT
+from utils.model_registry import model_registry
 
 load_dotenv()
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
 
 class CodeGeneratorAgent(AgentBase):
     description = "An agent that generates Python code based on a given prompt using the Gemini API."
+    # Generates files, must always run
+    cache_ttl = 0
 
     def __init__(self):
         self.data_store = {}
         self.functions = self.get_functions()
         super().__init__()
-        self.code_model = genai.GenerativeModel(model_name='gemini-1.5-pro-latest')
+        self.code_model = model_registry.get('gemini-1.5-pro-latest')
         self.user_long_prompt = ""
         self.can_generate = False
-        os.makedirs(output_folder, exist_ok=True)
 
     def get_functions(self):
         return {
@@ -42,7 +41,8 @@ class CodeGeneratorAgent(AgentBase):
         """
         # Use the Gemini API to generate code based on the prompt
         self.emit_debug_message("**CODE GENERATOR AGENT:** Generating code...", "CODE GENERATOR AGENT")
-        response = self.code_model.generate_content(prompt)
+        response = llm_scheduler.call(self.code_model.model_name, self.estimate_tokens(prompt), PRIORITY_CHAT, self.cancel_token,
+                                      self.code_model.generate_content, prompt)
         generated_code = response.text
         print("CODE GENERATOR AGENT: Code generated!")
         return generated_code
@@ -100,7 +100,7 @@ class CodeGeneratorAgent(AgentBase):
             """
             code = self.generate_code(code_generation_prompt)
             status = self.save_code_as_agent(code, agent_name)
-            File.write_md(code, response_path)
+            File.write_md(code, self.get_response_path())
             print(f"Code Generator Agent: {status}")
             self.can_generate = False
         else:
@@ -119,7 +119,7 @@ class CodeGeneratorAgent(AgentBase):
             Retrieve previously generated agent code
         """
         self.emit_debug_message("**CODE GENERATOR AGENT:** Code retrieved.", "CODE GENERATOR AGENT")
-        code = File.read_md(response_path)
+        code = File.read_md(self.get_response_path())
         return code
 
     def generate_response(self, user_prompt: str) -> str:
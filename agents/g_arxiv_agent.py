@@ -11,22 +11,19 @@
 # - The `save_response` method can be used to save the API response or other data to a file.
 
 # To use the agent, you can create an instance of the `ArxivAgent` class, and then call the `generate_response` method with the user's prompt as input. The agent will then interact with the arXiv API as needed, and generate a response based on the prompt.
-import os
 from dotenv import load_dotenv
 from agents.agent_base import AgentBase
 import google.generativeai as genai
 import urllib.request as libreq
 from utils.file import File
-from app_constants import RESPONSE
 import urllib.parse
 
 load_dotenv()
-output_folder = f"output/{__name__.split('.')[-1]}"
-os.makedirs(output_folder, exist_ok=True)
-response_path = f"{output_folder}/{RESPONSE}"
 
 class ArxivAgent(AgentBase):
     description = "An agent that interacts with the arXiv API to retrieve and process research papers."
+    # Paper metadata rarely changes
+    cache_ttl = 604800
 
     def __init__(self):
         self.data_store = {}
@@ -92,6 +89,6 @@ class ArxivAgent(AgentBase):
         result = self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
 
         # Save the response or data to a file if needed
-        File.write_md(result, response_path)
+        File.write_md(result, self.get_response_path())
 
         return result
\ No newline at end of file
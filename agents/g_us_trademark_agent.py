@@ -13,25 +13,21 @@
 
 # You can now use the `UsTrademarkAgent` class to perform trademark searches and retrievals using the Marker API V2.
 
-import os
 from dotenv import load_dotenv
 from agents.agent_base import AgentBase
 import google.generativeai as genai
 from utils.file import File
-from app_constants import RESPONSE
 
 load_dotenv()
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
 
 class UsTrademarkAgent(AgentBase):
     description = "A US Trademark Agent that interacts with the Marker API V2 to perform trademark searches and retrievals."
+    cache_ttl = 86400
 
     def __init__(self):
         self.data_store = {}
         self.functions = self.get_functions()
         super().__init__()
-        os.makedirs(output_folder, exist_ok=True)
 
     def get_functions(self):
         return {
@@ -147,6 +143,6 @@ class UsTrademarkAgent(AgentBase):
         result = self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
 
         # Save the response or data to a file if needed
-        File.write_md(result, response_path)
+        File.write_md(result, self.get_response_path())
 
         return result
\ No newline at end of file
@@ -1,24 +1,20 @@
 # wikipedia_agent.py
-import os
 from dotenv import load_dotenv
 from agents.agent_base import AgentBase
 import google.generativeai as genai
 from utils.file import File
-from app_constants import RESPONSE
 import wikipedia
 
 load_dotenv()
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
 
 class WikipediaAgent(AgentBase):
     description = "A Wikipedia Agent that can search and summarize information from Wikipedia."
+    cache_ttl = 86400
 
     def __init__(self):
         self.data_store = {}
         self.functions = self.get_functions()
         super().__init__()
-        os.makedirs(output_folder, exist_ok=True)
 
     def get_functions(self):
         return {
@@ -81,6 +77,6 @@ class WikipediaAgent(AgentBase):
         result = self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
 
         # Save the response or data to a file if needed
-        File.write_md(result, response_path)
+        File.write_md(result, self.get_response_path())
 
         return result
\ No newline at end of file
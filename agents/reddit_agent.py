@@ -1,35 +1,47 @@
 import os
+import threading
 from dotenv import load_dotenv
 import praw
 import json
-import google.generativeai as genai
 from agents.agent_base import AgentBase
 from utils.file import File
-from app_constants import RESPONSE, RESPONSE_STYLE
+from utils.single_flight import single_flight
+from utils.resilience import resilience
+from app_constants import RESPONSE_STYLE, ANALYSIS_TIME_RESERVE
 
 load_dotenv()
-genai.configure(api_key=os.environ["API_KEY"])
 client_id = os.getenv("REDDIT_CLIENT_ID")
 client_secret = os.getenv("REDDIT_CLIENT_SECRET")
 username = os.getenv("REDDIT_USERNAME")
 password = os.getenv("REDDIT_PASSWORD")
-reddit = praw.Reddit(
-    client_id=client_id,
-    client_secret=client_secret,
-    password=password,
-    user_agent=f'script by /u/{username}',
-    username=username
-)
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
+# Created on first use, so registering the agent doesn't open a Reddit session
+reddit = None
+reddit_lock = threading.Lock()
+
+def get_reddit():
+    global reddit
+    # Agents of several sessions may ask for the client at the same time, only one creates it
+    with reddit_lock:
+        if reddit is None:
+            reddit = praw.Reddit(
+                client_id=client_id,
+                client_secret=client_secret,
+                password=password,
+                user_agent=f'script by /u/{username}',
+                username=username
+            )
+        return reddit
+
+# Rough time to fetch one post with its comments, used to fit the number of posts to the request's deadline
+SECONDS_PER_POST = 1.5
 
 class RedditAgent(AgentBase):
     description = "An agent that can retrieve reddit posts and analyse them. It can be used to research any topics including games, technology, science, etc"
+    cache_ttl = 1800
     def __init__(self):
         self.functions = self.get_functions() 
         super().__init__()
         self.data_store = {}
-        os.makedirs(output_folder, exist_ok=True)
 
     def get_functions(self):
         return {
@@ -57,24 +69,57 @@ class RedditAgent(AgentBase):
                 str: Result message indicating the number of posts and comments found and stored.
         """
         print(f"REDDIT AGENT: Retrieving posts.")
+        if subreddits:
+            limit = max(1, self.fit_to_budget(limit * len(subreddits), SECONDS_PER_POST) // len(subreddits))
+        posts, total_comments, out_of_time = self.fetch_posts(subreddits, mode, query, sort_by, time_filter, limit)
+        if out_of_time:
+            self.mark_degraded(f"stopped after {len(posts)} posts")
+
+        for post_details in posts:
+            self.data_store[f"post_{post_details['id']}"] = post_details
+        self.data_store['post_ids'] = [post_details['id'] for post_details in posts]
+
+        result = f"Found {len(posts)} relevant posts with a total of {total_comments} comments retrieved."
+        return result
+
+    @single_flight
+    def fetch_posts(self, subreddits: list[str], mode: str, query: str, sort_by: str, time_filter: str, limit: int):
+        """
+        Download posts with their comments. Identical downloads from concurrent requests share one run,
+        the analysis of the posts stays with each request.
+
+        Returns:
+            tuple: (post details, total number of comments, whether it stopped early to fit the deadline)
+        """
         total_comments = 0
         posts = []
+        out_of_time = False
         for sub in subreddits:
-            subreddit = reddit.subreddit(sub)
+            self.check_cancelled()
+            if out_of_time:
+                break
+            subreddit = get_reddit().subreddit(sub)
             try:
+                # Listings are lazy, they are fetched (a hundred posts per request) here so failed requests can be retried
                 if mode == 'top':
-                    found_posts = subreddit.top(time_filter=time_filter, limit=limit)
+                    found_posts = resilience.call("reddit", self.cancel_token, lambda: list(subreddit.top(time_filter=time_filter, limit=limit)))
                 elif mode == 'search':
-                    found_posts = subreddit.search(query, sort=sort_by, time_filter=time_filter, limit=limit)
+                    found_posts = resilience.call("reddit", self.cancel_token, lambda: list(subreddit.search(query, sort=sort_by, time_filter=time_filter, limit=limit)))
                 else:
                     raise ValueError("Invalid mode specified. Use 'top' or 'search'.")
 
                 self.emit_debug_message(f"**REDDIT AGENT:** Retrieving comments...", "REDDIT AGENT")
                 for post in found_posts:
-                    comments = self.retrieve_comments(post.id)
+                    self.check_cancelled()
+                    remaining = self.remaining_time()
+                    if remaining is not None and remaining < ANALYSIS_TIME_RESERVE and posts:
+                        print(f"\nREDDIT AGENT: Running out of time, analysing the {len(posts)} posts retrieved so far.")
+                        out_of_time = True
+                        break
+                    comments = resilience.call("reddit", self.cancel_token, self.retrieve_comments, post.id)
                     total_comments += len(comments)
                     print(f"\rTotal comments retrieved so far: {total_comments}", end='', flush=True)
-                    post_details = {
+                    posts.append({
                         'id': post.id,
                         'title': post.title,
                         'author': post.author.name if post.author else None,
@@ -82,20 +127,15 @@ class RedditAgent(AgentBase):
                         'url': post.url,
                         'comments': comments,
                         'num_comments': post.num_comments
-                    }
-                    self.data_store[f'post_{post.id}'] = post_details
-                    posts.append(post.id)
+                    })
             except Exception as e:
                 print(f"\nError accessing subreddit {sub}: {e}")
 
         print()
-        self.data_store['post_ids'] = posts if posts else []
-
-        result = f"Found {len(posts)} relevant posts with a total of {total_comments} comments retrieved."
-        return result
+        return posts, total_comments, out_of_time
 
     def retrieve_comments(self, post_id, sort='best', comment_limit=5):
-        submission = reddit.submission(id=post_id)
+        submission = get_reddit().submission(id=post_id)
         submission.comment_sort = sort
         submission.comments.replace_more(limit=0)
         comments = [(comment.body, comment.score) for comment in submission.comments.list()[:comment_limit]]
@@ -123,7 +163,8 @@ class RedditAgent(AgentBase):
                           for post in posts]
         # summary_prompt = f"{instruction}\n\n{'; '.join(post_summaries)}"
 
-        summary_prompt = f"""
+        def build_prompt(post_summaries):
+            return f"""
         {instruction}
 
         {RESPONSE_STYLE}
@@ -133,19 +174,23 @@ class RedditAgent(AgentBase):
         {post_summaries}
         """        
 
+        # Posts come in the order reddit ranked them, so the least relevant are dropped first
+        summary_prompt = self.fit_prompt(build_prompt, post_summaries, instruction, strategy='truncate')
+
         print("REDDIT AGENT: Analyzing posts...")
         self.emit_debug_message(f"**REDDIT AGENT:** Analyzing posts...", "REDDIT AGENT")
-        analysis = self.pro_generate_analysis(summary_prompt)
+        response_path = self.get_response_path()
+        analysis = self.pro_generate_analysis(summary_prompt, response_path)
 
         File.write_md(analysis,response_path)
-        return f"Review analysis has been completed and is saved in '{output_folder}'"
+        return f"Review analysis has been completed and is saved in '{self.get_output_folder()}'"
 
     
     def retrieve_analysis(self):
         """Retrieve analysis generated earlier on.
         """
         print("Retrieving Analysis...")
-        analysis = File.read_md(response_path)
+        analysis = File.read_md(self.get_response_path())
 
         print(f"Got the analysis:\n\n{analysis}")
 
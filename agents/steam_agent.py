@@ -1,24 +1,31 @@
-import os
 from dotenv import load_dotenv
-import google.generativeai as genai
+import random
 import requests
 import steamreviews
 import json
 from agents.agent_base import AgentBase
 from utils.file import File
-from app_constants import RESPONSE, RESPONSE_STYLE
+from utils.single_flight import single_flight
+from utils.resilience import resilience
+from app_constants import RESPONSE_STYLE
 
 load_dotenv()
-genai.configure(api_key=os.environ["API_KEY"])
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
+# Rough costs used to fit the work to the request's deadline
+SECONDS_PER_DAY_OF_REVIEWS = 5
+SECONDS_PER_REVIEW = 0.02
+MIN_REVIEW_SAMPLE = 50
+# Game titles don't change, a clarified title is reused for a week
+CLARIFIED_TITLE_TTL = 604800
+# The app list is several megabytes
+APP_LIST_TIMEOUT = 60
 
 class SteamAgent(AgentBase):
     description = "An agent that can retrieve game reviews by specifying game name and analyse them."
+    # Reviews trickle in, an hour old sample is still representative
+    cache_ttl = 3600
     def __init__(self):
         self.functions = self.get_functions() 
         super().__init__()
-        os.makedirs(output_folder, exist_ok=True)
     
     def get_functions(self):
         return {
@@ -27,14 +34,17 @@ class SteamAgent(AgentBase):
             'retrieve_extract_and_analyze_reviews': self.retrieve_extract_and_analyze_reviews
         }
 
+    @staticmethod
+    def fetch_app_list():
+        response = requests.get("https://api.steampowered.com/ISteamApps/GetAppList/v2/", timeout=APP_LIST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()['applist']['apps']
+
     def get_steam_appid(self, game_name):
-        url = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
-        response = requests.get(url)
-        if response.status_code == 200:
-            apps = response.json()['applist']['apps']
-            for app in apps:
-                if game_name.lower() == app['name'].lower():
-                    return app['appid']
+        apps = resilience.call("steam", self.cancel_token, self.fetch_app_list)
+        for app in apps:
+            if game_name.lower() == app['name'].lower():
+                return app['appid']
         return None
 
     def extract_reviews_data(self, json_data):
@@ -78,10 +88,17 @@ class SteamAgent(AgentBase):
             if not reviews_details:
                 return "No reviews data available for analysis."
 
+            # Analyse a random sample when all the reviews don't fit in the time left
+            sample_size = self.fit_to_budget(len(reviews_details), SECONDS_PER_REVIEW, minimum=MIN_REVIEW_SAMPLE)
+            if sample_size < len(reviews_details):
+                self.emit_debug_message(f"**STEAM AGENT:** Short on time, analysing a sample of {sample_size} of {len(reviews_details)} reviews.", "STEAM AGENT")
+                reviews_details = random.sample(reviews_details, sample_size)
+
             review_texts = [f"Review: {review['review']}" for review in reviews_details]
             # analysis_prompt = f"{instruction}\n\n{' '.join(review_texts)}"
 
-            analysis_prompt = f"""
+            def build_prompt(review_texts):
+                return f"""
             {instruction}
 
             {RESPONSE_STYLE}
@@ -91,7 +108,11 @@ class SteamAgent(AgentBase):
             {review_texts}
         """   
 
-            analysis = self.pro_generate_analysis(analysis_prompt)
+            # Too many reviews for one prompt, a random sample is still representative
+            analysis_prompt = self.fit_prompt(build_prompt, review_texts, instruction, strategy='sample')
+
+            response_path = self.get_response_path()
+            analysis = self.pro_generate_analysis(analysis_prompt, response_path)
 
             File.write_md(analysis, response_path)
 
@@ -104,18 +125,19 @@ class SteamAgent(AgentBase):
         """
         Clarify game name as user might misspell or use accronymns
         """
-        # using another model instance so it doesn't affect steam agent message history
-        basic_model = genai.GenerativeModel('gemini-1.0-pro-latest')
-        response = basic_model.generate_content(f"Clarify this game title: {game_name} and respond with the game title only.")
-        clarified_game_name = response.text.strip()
+        # generated outside the chat so it doesn't affect steam agent message history
+        prompt = f"Clarify this game title: {game_name} and respond with the game title only."
+        clarified_game_name = self.generate_text('gemini-1.0-pro-latest', prompt, ttl=CLARIFIED_TITLE_TTL).strip()
         
         print("STEAM AGENT: Got it, looking for game reviews for ", clarified_game_name)
         
         return clarified_game_name
 
+    @single_flight
     def retrieve_reviews(self, game_name: str, day_range: int = 1):
         """
-        Retrieve game reviews based on game_name.
+        Retrieve game reviews based on game_name. Identical downloads from concurrent requests share one run,
+        the analysis of the reviews stays with each request.
 
         Args:
             game_name: the name of the game
@@ -131,10 +153,13 @@ class SteamAgent(AgentBase):
             request_params = dict()
             request_params['filter'] = 'all'
             request_params['day_range'] = f"{day_range}"
-            review_dict, query_count = steamreviews.download_reviews_for_app_id(app_id, chosen_request_params=request_params)
+            # steamreviews downloads every page in one call, so it can only be cancelled before and after
+            review_dict, query_count = resilience.call("steam", self.cancel_token, steamreviews.download_reviews_for_app_id,
+                                                       app_id, chosen_request_params=request_params)
 
             return app_id, review_dict
             extracted_data = self.extract_reviews_data(review_dict)
+            output_folder = self.get_output_folder()
             output_path = f"{output_folder}/{app_id}_reviews_extracted.json"
 
             with open(f"{output_folder}/{app_id}_reviews_raw.json", 'w', encoding='utf-8') as f:
@@ -150,6 +175,7 @@ class SteamAgent(AgentBase):
             print(f"STEAM AGENT: Whoops, no matching Steam game found for '{game_name}'.")
 
     def save_data(self, app_id, reviews, extracted_data):
+        output_folder = self.get_output_folder()
         raw_review_path = f"{output_folder}/{app_id}_reviews_raw.json"
         extracted_review_path = f"{output_folder}/{app_id}_reviews_extracted.json"
         with open(raw_review_path, 'w', encoding='utf-8') as f:
@@ -175,7 +201,10 @@ class SteamAgent(AgentBase):
         
         self.emit_debug_message(f"**STEAM AGENT:** Got it, retrieving reviews for {clarified_game_name}...", "STEAM AGENT")
         print(f"\nSTEAM AGENT: Looking for game reviews for {clarified_game_name} within day range of {day_range}.\n")
+        self.check_cancelled()
+        day_range = self.fit_to_budget(int(day_range), SECONDS_PER_DAY_OF_REVIEWS)
         app_id, reviews = self.retrieve_reviews(clarified_game_name, day_range)
+        self.check_cancelled()
         
         self.emit_debug_message(f"**STEAM AGENT:** Extracting important parts from the review data...", "STEAM AGENT")
         extracted_data = self.extract_reviews_data(reviews)
@@ -187,7 +216,7 @@ class SteamAgent(AgentBase):
         self.emit_debug_message(f"**STEAM AGENT:** Analyzing the review data now...", "STEAM AGENT")
         response = self.analyze_reviews(instruction, extracted_data_path)
 
-        self.emit_debug_message(f"**STEAM AGENT:** Done! Analysis saved in {response_path}", "STEAM AGENT")
+        self.emit_debug_message(f"**STEAM AGENT:** Done! Analysis saved in {self.get_response_path()}", "STEAM AGENT")
 
         return response
 
@@ -1,20 +1,26 @@
 # web_search_agent.py
 import os
-import requests
+import asyncio
+import aiohttp
 from newspaper import Article
 import json
 from dotenv import load_dotenv
 from agents.agent_base import AgentBase
-import google.generativeai as genai
 from utils.file import File
-from app_constants import RESPONSE, RESPONSE_STYLE
+from utils.single_flight import single_flight
+from utils.async_loop import run_sync
+from utils.resilience import resilience, CircuitOpenError
+from app_constants import RESPONSE_STYLE, ANALYSIS_TIME_RESERVE
 
 load_dotenv()
-output_folder = f"output/{__name__.split('.')[-1]}"
-response_path = f"{output_folder}/{RESPONSE}"
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# Pages download concurrently, but every page makes the summary slower. Used to fit num_results to the request's deadline
+SECONDS_PER_PAGE = 3
 
 class WebSearchAgent(AgentBase):
     description = "An agent that performs web searches, processes search results, extracts relevant content, and summarizes the content."
+    cache_ttl = 3600
+    async_native = True
 
     def __init__(self):
         self.base_url = "https://api.search.brave.com/res/v1/web/search"
@@ -27,7 +33,6 @@ class WebSearchAgent(AgentBase):
         self.data_store = {}
         self.functions = self.get_functions()
         super().__init__()
-        os.makedirs(output_folder, exist_ok=True)
 
     def get_functions(self):
         return {
@@ -38,20 +43,38 @@ class WebSearchAgent(AgentBase):
             'search_extract_summarize': self.search_extract_summarize
         }
     
-    def search_extract_summarize(self, search_query: str, num_results: int = 10) -> str:
-        self.search_web(search_query, num_results)
-        if self.data_store["search_results"]:
-            self.extract_relevant_content()
-            if self.data_store["extracted_content"]:
-                response = self.summarize_content()
+    async def search_extract_summarize(self, search_query: str, num_results: int = 10) -> str:
+        num_results = self.fit_to_budget(int(num_results), SECONDS_PER_PAGE)
+        search_results, extracted_content = await self.fetch_pages(search_query, num_results)
+        self.data_store["search_results"] = search_results
+        self.data_store["extracted_content"] = extracted_content
+        if search_results:
+            if extracted_content:
+                await asyncio.to_thread(self.save_extracted_content, extracted_content)
+                response = await self.summarize_content()
                 return response
             else:
                 return "WEB SEARCH AGENT: No data extracted"
         else:
             return "WEB SEARCH AGENT: No relevant search results"
 
+    @single_flight
+    async def fetch_pages(self, search_query: str, num_results: int):
+        """
+        Search and download the result pages. Identical searches from concurrent requests share one run,
+        the summary and the saved files stay with each request.
 
-    def search_web(self, search_query: str, num_results: int = 10) -> str:
+        Returns:
+            tuple: (search results, main text of every page that could be extracted)
+        """
+        self.data_store.pop("search_results", None)
+        self.data_store.pop("extracted_content", None)
+        await self.search_web(search_query, num_results)
+        if self.data_store.get("search_results"):
+            await self.extract_relevant_content()
+        return self.data_store.get("search_results", []), self.data_store.get("extracted_content", [])
+
+    async def search_web(self, search_query: str, num_results: int = 10) -> str:
         """
         Perform a web search using the Brave Search API.
 
@@ -69,11 +92,15 @@ class WebSearchAgent(AgentBase):
             "count": num_results
         }
 
+        async def fetch_search_results(session):
+            async with session.get(self.base_url, params=params, headers=self.headers) as response:
+                print(f"WEB SEARCH AGENT DEBUG: RESPONSE: \n\n{response}")
+                response.raise_for_status()
+                return await response.json()
+
         try:
-            response = requests.get(self.base_url, params=params, headers=self.headers)
-            print(f"WEB SEARCH AGENT DEBUG: RESPONSE: \n\n{response}")
-            response.raise_for_status()
-            search_data = response.json()
+            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+                search_data = await resilience.acall("brave_search", fetch_search_results, session)
 
             if "web" in search_data and "results" in search_data["web"]:
                 search_results = search_data["web"]["results"]
@@ -83,12 +110,48 @@ class WebSearchAgent(AgentBase):
             else:
                 return "No search results found."
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
             return f"Error occurred while making the request to Brave Search API: {str(e)}"
 
-    def extract_relevant_content(self) -> str:
+    @staticmethod
+    def parse_article(url, html):
+        """
+        Extract the main text of a downloaded page. Blocking, run on a worker thread.
+        """
+        article = Article(url)
+        article.download(input_html=html)
+        article.parse()
+        return article.text
+
+    def save_extracted_content(self, extracted_content):
+        output_folder = self.get_output_folder()
+        for index, main_content in enumerate(extracted_content):
+            output_file = f"{output_folder}/result_{index}.txt"
+            with open(output_file, "w", encoding="utf-8") as file:
+                file.write(main_content)
+        print("WEB SEARCH AGENT: Saved to output folder")
+
+    async def download_article(self, session, url):
+        """
+        Download one search result and extract its main text. Returns None if the page can't be processed.
+        """
+        self.check_cancelled()
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                html = await response.text(errors="replace")
+
+            # Parsing blocks, keep it off the shared event loop
+            return await asyncio.to_thread(self.parse_article, url, html)
+
+        except Exception as e:
+            print(f"Error processing URL: {url}")
+            print(f"Error message: {str(e)}")
+            return None
+
+    async def extract_relevant_content(self) -> str:
         """
-        Extract relevant content from the selected search results.
+        Extract relevant content from the selected search results. All pages are downloaded concurrently.
 
         Returns:
             str: Status of the content extraction.
@@ -100,26 +163,18 @@ class WebSearchAgent(AgentBase):
         if not relevant_results:
             return "No relevant results found for content extraction."
 
-        extracted_content = []
-        for index, result in enumerate(relevant_results):
-            url = result["url"]
-
-            try:
-                article = Article(url)
-                article.download()
-                article.parse()
-
-                main_content = article.text
-                extracted_content.append(main_content)
+        # Slow pages are dropped earlier when the deadline is close
+        timeout = REQUEST_TIMEOUT
+        remaining = self.remaining_time()
+        if remaining is not None:
+            timeout = aiohttp.ClientTimeout(total=max(min(REQUEST_TIMEOUT.total, remaining - ANALYSIS_TIME_RESERVE), 5))
+            if timeout.total < REQUEST_TIMEOUT.total:
+                self.mark_degraded(f"pages limited to {timeout.total:.0f}s")
 
-                output_file = f"{output_folder}/result_{index}.txt"
-                with open(output_file, "w", encoding="utf-8") as file:
-                    file.write(main_content)
-                print("WEB SEARCH AGENT: Saved to output folder")
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            contents = await self.await_cancellable(asyncio.gather(*(self.download_article(session, result["url"]) for result in relevant_results)))
+        extracted_content = [content for content in contents if content is not None]
 
-            except Exception as e:
-                print(f"Error processing URL: {url}")
-                print(f"Error message: {str(e)}")
         print("WEB SEARCH AGENT: Saving extracted content")
         self.data_store["extracted_content"] = extracted_content
         # return f"Extracted content from {len(extracted_content)} search results."
@@ -127,7 +182,7 @@ class WebSearchAgent(AgentBase):
         self.emit_debug_message(f"**WEB SEARCH AGENT:** Extracted web content from {len(extracted_content)} search results.", "WEB SEARCH AGENT")
 
 
-    def summarize_content(self) -> str:
+    async def summarize_content(self) -> str:
         """
         Summarize the extracted content.
 
@@ -139,9 +194,9 @@ class WebSearchAgent(AgentBase):
         if not extracted_content:
             return "No extracted content found for summarization."
 
-        combined_content = "\n".join(extracted_content)
-        
-        summary_prompt = f"""
+        def build_prompt(contents):
+            combined_content = "\n\n".join(contents)
+            return f"""
         Please analyse and summarize the following web content and write an article.
         
         {RESPONSE_STYLE}
@@ -149,11 +204,15 @@ class WebSearchAgent(AgentBase):
         {combined_content}
         """
 
+        # Condensed with map-reduce first if the pages are too large for a single prompt
+        summary_prompt = await self.afit_prompt(build_prompt, extracted_content, "Analyse and summarize the web content and write an article.", strategy='summarize')
+
         print(f"SUMMARY PROMPT:\n\n{summary_prompt}")
 
         self.emit_debug_message(f"**WEB SEARCH AGENT:** Summarizing web contents...", "WEB SEARCH AGENT")
 
-        summary = self.pro_generate_analysis(summary_prompt)
+        response_path = self.get_response_path()
+        summary = await self.apro_generate_analysis(summary_prompt, response_path)
         # summary = json.loads(summary_response)["response"]
 
         # summary_data = {
@@ -171,7 +230,7 @@ class WebSearchAgent(AgentBase):
         self.emit_debug_message(f"**WEB SEARCH AGENT:** Done!", "WEB SEARCH AGENT")
         return f"Generated summary and saved to {response_path}"
 
-    def generate_response(self, prompt: str) -> str:
+    async def agenerate_response(self, prompt: str) -> str:
         if self.first_conversation:
             prompt = f"""
                 Based on user input, perform a web search, extract relevant content, and summarize the content.
@@ -179,10 +238,13 @@ class WebSearchAgent(AgentBase):
                 User: {prompt}
                 
             """
-        result = self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
+        result = await self.aexecute_function_sequence(self.model, self.functions, prompt, self.chat)
 
         # with open(f"{output_folder}/response.json", "w") as file:
         #     json.dump(self.data_store, file)
         
 
-        return result
\ No newline at end of file
+        return result
+
+    def generate_response(self, prompt: str) -> str:
+        return run_sync(self.agenerate_response(prompt))
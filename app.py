@@ -1,22 +1,119 @@
 import random
+import re
 from flask import Flask, request, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 import shutil
 
 import logging
 from manager.agent_manager import AgentManager
 from extensions import socketio
+from utils.session_pool import SessionPool
+from utils.agent_registry import discover_agents
+from utils.job_queue import JobQueue, QueueFullError
+from utils.deadline import Deadline
+from agents.agent_base import llm_cache
+from utils.prompt_budget import prompt_size_log
+from utils.resilience import resilience
+from app_constants import MAX_SESSIONS, SESSION_IDLE_TIMEOUT, JOB_WORKERS, MAX_QUEUED_JOBS, MAX_QUEUED_JOBS_PER_USER, OUTPUT_ROOT
 
 app = Flask(__name__)
 socketio.init_app(app)
 
 # Clear all agent's responses after reset
-shutil.rmtree('output', ignore_errors=True)
-agent_manager = AgentManager()
+shutil.rmtree(OUTPUT_ROOT, ignore_errors=True)
+
+def drop_session(session_id, agent_manager):
+    # A dropped session's agents still running in the background are stopped and its reports deleted
+    agent_manager.cancel_pending_agents("Session closed")
+    shutil.rmtree(session_output_root(session_id), ignore_errors=True)
+
+def emit_job_status(job):
+    # Clients receive updates for the jobs they subscribed to with the 'subscribe_job' event
+    socketio.emit('job_status', job.to_dict(), to=job.id)
+
+job_queue = JobQueue(JOB_WORKERS, MAX_QUEUED_JOBS, MAX_QUEUED_JOBS_PER_USER, on_status_change=emit_job_status)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def get_session_id(data):
+    # Clients that don't send a session id share the default session
+    return str((data or {}).get("session_id") or "default")
+
+def session_room(session_id):
+    return f"session-{session_id}"
+
+def session_output_root(session_id):
+    # Session ids come from the client, only keep characters that are safe in a folder name
+    return f"{OUTPUT_ROOT}/{re.sub(r'[^A-Za-z0-9_-]', '_', session_id)}"
+
+manager_pool = SessionPool(AgentManager, MAX_SESSIONS, SESSION_IDLE_TIMEOUT, on_drop=drop_session)
+
+def run_agent_request(job, session_id, user_input, agent_keys, deadline=None):
+    # Runs on a job queue worker
+    def emit_progress(agent, markdown):
+        socketio.emit('job_progress', {'job_id': job.id, 'agent': agent, 'markdown': markdown}, to=job.id)
+
+    def emit_stream(agent, text):
+        # Job subscribers and the session's own tabs, which call /api and don't know the job id
+        socketio.emit('analysis_stream', {'job_id': job.id, 'agent': agent, 'text': text}, to=[job.id, session_room(session_id)])
+
+    with manager_pool.session(session_id) as agent_manager:
+        # The job may have been cancelled while it waited for the session's previous request
+        job.cancel_token.raise_if_cancelled()
+        # Reports and debug messages are only visible to this session
+        agent_manager.output_root = session_output_root(session_id)
+        agent_manager.debug_room = session_room(session_id)
+        agent_manager.progress_callback = emit_progress
+        agent_manager.stream_callback = emit_stream
+        agent_manager.cancel_token = job.cancel_token
+        # Time spent in the queue counts against the deadline
+        agent_manager.deadline = deadline
+        try:
+            agent_manager.set_agents(agent_keys)
+            return agent_manager.generate_response(user_input)
+        finally:
+            # cancel_token is left in place, work abandoned by a cancelled job keeps seeing it until the next job
+            agent_manager.progress_callback = None
+            agent_manager.stream_callback = None
+
+def submit_agent_request(data):
+    """
+    Validate an /api or /jobs request body and queue it.
+
+    Returns:
+        tuple: (job, None) or (None, error response)
+    """
+    user_input = (data or {}).get("input")
+    agent_keys = (data or {}).get("agent_keys", [])  # Default to empty list if not provided
+
+    if not user_input:
+        return None, (jsonify({'error': 'No input provided'}), 400)
+
+    deadline = None
+    if data.get("deadline_seconds") is not None:
+        try:
+            deadline = Deadline.after(float(data["deadline_seconds"]))
+        except (TypeError, ValueError):
+            return None, (jsonify({'error': 'deadline_seconds must be a number'}), 400)
+
+    session_id = get_session_id(data)
+    if data.get("cancel_previous"):
+        # A new prompt replaces whatever this session was still working on
+        job_queue.cancel_user_jobs(session_id, "Replaced by a new prompt")
+    try:
+        return job_queue.submit(session_id, run_agent_request, session_id, user_input, agent_keys, deadline), None
+    except QueueFullError as e:
+        logging.warning(f"Rejected request from session {session_id}: {e}")
+        return None, (jsonify({'error': str(e)}), 429, {'Retry-After': '30'})
+
+def job_result(job):
+    response, responses_md = job.result
+    return {
+        'response': response,
+        'markdown': responses_md
+    }
+
 # Path for our main Svelte page
 @app.route("/")
 def base():
@@ -29,45 +126,123 @@ def home(path):
 
 @app.route('/create-manager', methods=['POST']) 
 def create_manager():
-    agent_manager = AgentManager()
+    data = request.get_json(force=True, silent=True, cache=False)
+    manager_pool.reset(get_session_id(data))
     return jsonify({'response': 'Manager created'}), 200
 
 
 @app.route('/get-agents', methods=['POST'])
 def get_agents():
-    agents = agent_manager.get_all_agents()
+    # Doesn't need a session's manager, so it never waits behind a running request
+    agents = list(discover_agents().keys())
     return jsonify({'agents': agents}), 200
 
 @app.route('/api', methods=['POST'])
 def get_response():
     data = request.get_json(force=True, silent=True, cache=False)
     # socketio.emit('debug', {'message': f"Received Data: {data}"})  # Emit debug info
-    
-    user_input = data.get("input")
-    agent_keys = data.get("agent_keys", [])  # Default to empty list if not provided
-    
-    if not user_input:
-        return jsonify({'error': 'No input provided'}), 400
-    
-    agent_manager.set_agents(agent_keys)
 
-    try:
-        response, responses_md = agent_manager.generate_response(user_input)
+    job, error = submit_agent_request(data)
+    if error:
+        return error
+
+    job.wait()
+    if job.status == 'failed':
+        logging.error(f"An error occurred: {job.error}")
+        return jsonify({'error': job.error}), 500
+    if job.status == 'cancelled':
+        return jsonify({'error': job.error}), 409
+
+    return jsonify(job_result(job)), 200
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a research request and return its job id right away. Progress is pushed over SocketIO
+    ('job_status', 'job_progress' and 'analysis_stream' events, after emitting 'subscribe_job'), and the final result
+    is available from GET /jobs/<job_id>.
+    """
+    data = request.get_json(force=True, silent=True, cache=False)
+
+    job, error = submit_agent_request(data)
+    if error:
+        return error
+
+    return jsonify(job.to_dict()), 202
 
-        responseData = {
-            'response': response,
-            'markdown': responses_md 
-        }
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
 
-        return jsonify(responseData), 200
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        return jsonify({'error': str(e)}), 500
+    job_data = job.to_dict()
+    if job.status == 'done':
+        job_data.update(job_result(job))
+    return jsonify(job_data), 200
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'llm_cache': llm_cache.stats()}), 200
+
+@app.route('/prompt-stats', methods=['GET'])
+def prompt_stats():
+    # Original vs sent size of recent prompts, see AgentBase.fit_prompt
+    return jsonify({'prompts': prompt_size_log.recent()}), 200
+
+@app.route('/resilience-stats', methods=['GET'])
+def resilience_stats():
+    # Circuit breaker state and retry budget usage of every endpoint, see utils/resilience.py
+    return jsonify({'endpoints': resilience.stats()}), 200
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    cancelled = job_queue.cancel(job_id)
+    # Agents the job left running in the background belong to the session's manager
+    agent_manager = manager_pool.peek(job.user_id)
+    if agent_manager is not None:
+        cancelled = agent_manager.cancel_pending_agents("Cancelled by user", job.cancel_token) > 0 or cancelled
+    if not cancelled:
+        return jsonify({'error': 'Job already finished'}), 404
+    return jsonify(job.to_dict()), 200
+
+# SocketIO connection id -> session id, so a closed tab cancels the session's jobs
+socket_sessions = {}
 
 @socketio.on('connect')
 def test_connect():
     emit('after connect',  {'data':'Let\'s communicate!'})
 
+@socketio.on('register_session')
+def register_session(data):
+    socket_sessions[request.sid] = get_session_id(data)
+    # Streamed analyses are sent to the session's room
+    join_room(session_room(socket_sessions[request.sid]))
+
+@socketio.on('disconnect')
+def on_disconnect():
+    session_id = socket_sessions.pop(request.sid, None)
+    if session_id is not None and session_id not in socket_sessions.values():
+        cancelled = job_queue.cancel_user_jobs(session_id, "Client disconnected")
+        agent_manager = manager_pool.peek(session_id)
+        if agent_manager is not None:
+            cancelled += agent_manager.cancel_pending_agents("Client disconnected")
+        if cancelled:
+            logging.info(f"Cancelled {cancelled} jobs and agents of disconnected session {session_id}")
+
+@socketio.on('subscribe_job')
+def subscribe_job(data):
+    job = job_queue.get((data or {}).get('job_id'))
+    if job is None:
+        emit('job_status', {'job_id': (data or {}).get('job_id'), 'status': 'not_found'})
+        return
+    join_room(job.id)
+    # Send the current status in case the job moved on before the client subscribed
+    emit('job_status', job.to_dict())
+
 if __name__ == "__main__":
     app.run(debug=True)  # Set debug=False in a production environment
     socketio.run(app)
@@ -1,5 +1,123 @@
 print("Executing app_constants.py")
 RESPONSE = "response.md"
+# Agents write their reports to OUTPUT_ROOT/<agent key>, requests from the web app use OUTPUT_ROOT/<session id>/<agent key>
+OUTPUT_ROOT = "output"
 # Use this in analysis or summary prompt to set response style. Can try formal tone, friendly, essay style, listicle, etc
 RESPONSE_STYLE = "Use markdown format with relevant heading and subheadings."
-print(f"RESPONSE constant defined: {RESPONSE}")
\ No newline at end of file
+print(f"RESPONSE constant defined: {RESPONSE}")
+
+# Maximum seconds the manager waits for each delegated agent before consolidating without it
+AGENT_TIMEOUT = 300
+# Function calling (AgentBase.execute_function_sequence): seconds each tool call may run, characters of a tool
+# result sent back to the model, and rounds of function calls before the model must answer
+TOOL_TIMEOUT = 240
+MAX_TOOL_RESULT_CHARS = 20000
+MAX_FUNCTION_ROUND_TRIPS = 8
+# LLM backend: "gemini", or "fake" for the local fake used to benchmark without a network (utils/fake_llm.py).
+# The LLM_BACKEND environment variable overrides it. The fake answers after FAKE_LLM_LATENCY seconds
+# plus FAKE_LLM_SECONDS_PER_TOKEN for each of its FAKE_LLM_OUTPUT_TOKENS tokens
+LLM_BACKEND = "gemini"
+FAKE_LLM_LATENCY = 0.5
+FAKE_LLM_OUTPUT_TOKENS = 200
+FAKE_LLM_SECONDS_PER_TOKEN = 0.005
+
+# Chat history compaction: once a chat's history is over HISTORY_COMPACT_TOKENS, the turns before the last
+# HISTORY_KEEP_RECENT_TOKENS are replaced by a summary written by HISTORY_SUMMARY_MODEL, and function responses
+# in the kept turns are cut to HISTORY_FUNCTION_RESPONSE_CHARS. The chat model has a 30k token context
+HISTORY_COMPACT_TOKENS = 16000
+HISTORY_KEEP_RECENT_TOKENS = 6000
+HISTORY_FUNCTION_RESPONSE_CHARS = 2000
+HISTORY_SUMMARY_MODEL = "gemini-1.5-flash-latest"
+# Condense each agent's report as soon as it arrives, so the final consolidation only merges the condensed reports
+INCREMENTAL_CONSOLIDATION = True
+
+# Map-reduce summarizer (AgentBase.map_reduce_summarize). Token counts are estimates, ~4 characters per token.
+# Chunks and the manager's consolidation are also kept within the analysis models' prompt budgets
+MAP_REDUCE_CHUNK_TOKENS = 30000
+MAP_REDUCE_TARGET_TOKENS = 60000
+MAP_REDUCE_MAX_LEVELS = 3
+
+# Each browser session gets its own AgentManager. Idle sessions are dropped after SESSION_IDLE_TIMEOUT seconds
+MAX_SESSIONS = 20
+SESSION_IDLE_TIMEOUT = 1800
+
+# Agent results are cached here, outside the output folder that is cleared on every restart.
+# Each agent sets its own freshness window with the cache_ttl class attribute
+RESULT_CACHE_PATH = "cache/agent_results.json"
+
+# delegate_task stops waiting once DELEGATION_QUORUM (fraction) of the agents reported and the others had
+# QUORUM_GRACE_PERIOD more seconds, or after DELEGATION_SOFT_TIMEOUT seconds if at least one agent reported.
+# Agents still running are kept as pending, their reports can be merged in a follow-up
+DELEGATION_QUORUM = 0.5
+QUORUM_GRACE_PERIOD = 20
+DELEGATION_SOFT_TIMEOUT = 120
+
+# /api requests are run by JOB_WORKERS worker threads. Requests beyond the queue limits are rejected with 429
+JOB_WORKERS = 4
+MAX_QUEUED_JOBS = 32
+MAX_QUEUED_JOBS_PER_USER = 4
+
+# Latency budgets: requests may set deadline_seconds, and agents size their work to the time left
+# Seconds each agent keeps free for its final analysis call
+ANALYSIS_TIME_RESERVE = 40
+# Seconds the manager keeps free after its agents for the final consolidation
+CONSOLIDATION_TIME_RESERVE = 30
+# Analyses switch to the faster model when less than this many seconds are left
+FAST_MODEL_BELOW_SECONDS = 90
+FAST_ANALYSIS_MODEL = "gemini-1.5-flash-latest"
+ANALYSIS_MODEL = "gemini-1.5-pro-latest"
+
+# Default safety settings for analysis calls. Reviews and posts quote users verbatim, so nothing is blocked by default
+ANALYSIS_SAFETY_SETTINGS = {
+    'HATE': 'BLOCK_NONE',
+    'HARASSMENT': 'BLOCK_NONE',
+    'SEXUAL': 'BLOCK_NONE',
+    'DANGEROUS': 'BLOCK_NONE'
+}
+
+# LLM responses are cached on disk by a hash of model, settings and prompt. The least recently used
+# entries are evicted beyond LLM_CACHE_MAX_BYTES, and entries older than LLM_CACHE_TTL seconds are regenerated
+LLM_CACHE_PATH = "cache/llm"
+LLM_CACHE_MAX_BYTES = 200 * 1024 * 1024
+LLM_CACHE_TTL = 86400
+
+# Maximum prompt tokens per model, kept well below the context windows so analyses stay fast.
+# Larger prompts are reduced by AgentBase.fit_prompt. PROMPT_COUNT_WITH_API counts prompts near the budget with the API.
+# A budget is capped at the model's tokens per minute (LLM_RATE_LIMITS) minus PROMPT_OUTPUT_RESERVE for the answer,
+# see AgentBase.prompt_token_budget
+PROMPT_TOKEN_BUDGETS = {
+    "gemini-1.5-pro-latest": 100000,
+    "gemini-1.5-flash-latest": 100000,
+    "gemini-1.0-pro": 28000,
+    "gemini-1.0-pro-latest": 28000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 28000
+PROMPT_COUNT_WITH_API = True
+PROMPT_OUTPUT_RESERVE = 4000
+
+# Gemini rate limits per model: (requests per minute, tokens per minute). Calls wait in the LLM scheduler until
+# they fit, and a call that still gets a 429 pauses the model (for LLM_RATE_LIMIT_PAUSE seconds unless the API
+# says how long) and is queued again
+LLM_RATE_LIMITS = {
+    "gemini-1.5-pro-latest": (2, 32000),
+    "gemini-1.5-flash-latest": (15, 1000000),
+    "gemini-1.0-pro": (15, 32000),
+    "gemini-1.0-pro-latest": (15, 32000),
+}
+DEFAULT_LLM_RATE_LIMIT = (15, 32000)
+LLM_RATE_LIMIT_PAUSE = 30
+
+# Transient errors (429, 5xx, connection errors and timeouts) from Gemini and the data sources are retried up to
+# RETRY_ATTEMPTS times. Delays grow from RETRY_BASE_DELAY up to RETRY_MAX_DELAY with full jitter, or follow Retry-After
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+# Retries of an endpoint may add at most RETRY_BUDGET_RATIO of its calls in the last RETRY_BUDGET_WINDOW seconds,
+# plus RETRY_BUDGET_MIN_RETRIES, so they can't multiply the load on a struggling dependency
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MIN_RETRIES = 3
+RETRY_BUDGET_WINDOW = 60
+# After CIRCUIT_FAILURE_THRESHOLD transient failures in a row an endpoint fails fast for CIRCUIT_RESET_TIMEOUT
+# seconds, then a single trial call decides whether it is used again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
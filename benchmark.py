@@ -0,0 +1,125 @@
+"""
+Benchmark the orchestration (manager, delegation, function calling, scheduling) offline with the fake LLM backend.
+
+Every request runs on its own AgentManager, like one browser session, and delegates to --agents benchmark agents.
+Each agent calls one tool that takes --tool-seconds and writes an analysis. Compare the latencies with the fake
+LLM's simulated seconds to see how much time the orchestration itself adds.
+
+Usage: python benchmark.py --requests 8 --agents 3 --latency 0.5
+"""
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.fake_llm import FakeBackend
+from utils.llm_backend import set_backend
+from utils.llm_scheduler import llm_scheduler
+from utils.llm_cache import LLMCache
+from utils.file import File
+from app_constants import OUTPUT_ROOT
+import agents.agent_base as agent_base
+from agents.agent_base import AgentBase
+from manager.agent_manager import AgentManager
+
+
+class BenchmarkAgent(AgentBase):
+    description = "A benchmark agent that researches any topic."
+    # Every run must do the work
+    cache_ttl = 0
+    key = "benchmark_agent"
+    tool_seconds = 1.0
+
+    def __init__(self):
+        self.functions = self.get_functions()
+        super().__init__()
+
+    def get_functions(self):
+        return {'research': self.research}
+
+    def research(self, instruction: str) -> str:
+        """
+        Research a topic and write a report.
+
+        Args:
+            instruction (str): what to research.
+
+        Returns:
+            str: where the report is saved.
+        """
+        # Stands in for the network calls of a real agent
+        time.sleep(self.tool_seconds)
+        report_path = self.get_response_path()
+        analysis = self.pro_generate_analysis(f"Write a report about: {instruction}", report_path)
+        File.write_md(analysis, report_path)
+        return f"Report saved in {report_path}"
+
+    def get_output_folder(self):
+        # Every benchmark agent is defined in this module, the manager looks for its report under its key
+        output_folder = f"{self.output_root}/{self.key}"
+        os.makedirs(output_folder, exist_ok=True)
+        return output_folder
+
+    def generate_response(self, prompt: str) -> str:
+        return self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
+
+
+def create_agent_classes(count, tool_seconds):
+    return {
+        f"benchmark_agent_{index}": type(f"BenchmarkAgent{index}", (BenchmarkAgent,), {'key': f"benchmark_agent_{index}", 'tool_seconds': tool_seconds})
+        for index in range(count)
+    }
+
+
+def run_request(agent_classes, index):
+    agent_manager = AgentManager()
+    # Like the app's sessions, each request writes its reports to its own folder
+    agent_manager.output_root = f"{OUTPUT_ROOT}/benchmark_{index}"
+    agent_manager.agent_classes.update(agent_classes)
+    agent_manager.set_agents(list(agent_classes))
+    started_at = time.monotonic()
+    agent_manager.generate_response(f"Benchmark request {index}")
+    return time.monotonic() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agent orchestration with a fake LLM.")
+    parser.add_argument("--requests", type=int, default=4, help="requests to run")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests running at the same time")
+    parser.add_argument("--agents", type=int, default=3, help="agents each request delegates to")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the fake LLM answers")
+    parser.add_argument("--output-tokens", type=int, default=200, help="tokens in every fake answer")
+    parser.add_argument("--seconds-per-token", type=float, default=0.005, help="generation time per fake token")
+    parser.add_argument("--tool-seconds", type=float, default=1.0, help="seconds each agent's tool takes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    agent_classes = create_agent_classes(args.agents, args.tool_seconds)
+    backend = FakeBackend(args.latency, args.output_tokens, args.seconds_per_token, tool_calls={
+        'delegate_task': {'agents': list(agent_classes), 'agent_instructions': ["Research the benchmark topic."] * len(agent_classes)},
+        'research': {'instruction': "the benchmark topic"},
+    })
+    set_backend(backend)
+    # The fake has no quota and every run must reach the LLM
+    llm_scheduler.rate_limits = {}
+    llm_scheduler.default_rate_limit = (10 ** 6, 10 ** 9)
+    agent_base.llm_cache = LLMCache(tempfile.mkdtemp(prefix="llm-cache-"), 0, 0)
+    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(lambda index: run_request(agent_classes, index), range(args.requests)))
+    elapsed = time.monotonic() - started_at
+
+    stats = backend.stats()
+    latencies.sort()
+    print(f"\nRequests: {args.requests} ({args.concurrency} at a time), {args.agents} agents each")
+    print(f"Wall time: {elapsed:.2f}s, throughput: {args.requests / elapsed:.2f} requests/s")
+    print(f"Latency: p50 {statistics.median(latencies):.2f}s, p95 {latencies[int(0.95 * (len(latencies) - 1))]:.2f}s, max {latencies[-1]:.2f}s")
+    print(f"LLM calls: {stats['calls']}, prompt tokens: {stats['prompt_tokens']}, simulated LLM time: {stats['simulated_seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
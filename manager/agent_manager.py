@@ -1,49 +1,81 @@
 print(dir())
 import os
+import asyncio
+import math
 import importlib
 import pkgutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import List, Dict
-from agents.agent_base import AgentBase
+from agents.agent_base import AgentBase, AnalysisError
 from utils.agent_registry import discover_agents
 from dotenv import load_dotenv
 from flask_socketio import SocketIO, emit
 from utils.file import File
+from utils.task_graph import TaskGraph, TaskGraphError
+from utils.async_loop import run_sync
+from utils.result_cache import ResultCache
+from utils.single_flight import normalize_argument
+from utils.cancellation import CANCEL_POLL_INTERVAL, CancelToken
+from utils.llm_scheduler import PRIORITY_MANAGER
 
 
 
-import google.generativeai as genai
 import json
 import logging
 
 load_dotenv()
-genai.configure(api_key=os.environ["API_KEY"])
-output_folder = "output/manager_agent"
-os.makedirs(output_folder, exist_ok=True)
 
 from utils.file import File
-from app_constants import RESPONSE
-response_path = f"{output_folder}/{RESPONSE}"
+from app_constants import RESPONSE, AGENT_TIMEOUT, INCREMENTAL_CONSOLIDATION, MAP_REDUCE_TARGET_TOKENS, RESULT_CACHE_PATH, CONSOLIDATION_TIME_RESERVE
+from app_constants import DELEGATION_QUORUM, QUORUM_GRACE_PERIOD, DELEGATION_SOFT_TIMEOUT
+
+# Shared by every session, so a question one user asked recently is answered from cache for everyone
+result_cache = ResultCache(RESULT_CACHE_PATH)
 
 DELEGATE_PROMPT_DEBUG = False
 
 class AgentManager(AgentBase):
+    # Consolidation is what the user is waiting for, it goes ahead of the agents' bulk analyses
+    analysis_priority = PRIORITY_MANAGER
+    # Delegation enforces its own time limits (AGENT_TIMEOUT, quorum and the request's deadline)
+    tool_timeout = None
+    # The delegation tools share condensed_reports, delegated_agents, the agent locks and the manager's report
+    parallel_tools = False
+
     def __init__(self):
         self.functions = self.get_functions()  # Define self.functions before calling super().__init__()
         super().__init__()
         self.agent_classes = discover_agents()
         print(f"LOADED AGENTS: {self.agent_classes}")
         self.agents = {}
+        self.agent_instances = {}
+        self.agents_to_reset = set()
         self.data_store = {}
         self.delegated_agents = []
+        self.timed_out_agents = []
+        # Agents still running when their delegation was consolidated, see merge_pending_reports(). Each one has
+        # its own cancel token, so the session can stop them after the job that started them has finished
+        self.pending_agents = {}
+        self.agent_locks = {}
+        # Every delegation gets a new id. Reports and condensed reports are tagged with the delegation that
+        # produced them, so a late report is never mistaken for one of a later delegation
+        self.delegation_id = 0
+        self.report_delegations = {}
+        self.condensed_reports = {}
+        # Called with (agent, report markdown) on a worker thread as soon as an agent's report is ready
+        self.progress_callback = None
         self.code_generator_enabled = False
-        os.makedirs(output_folder, exist_ok=True)
 
 
 
     def get_functions(self):
         return {
             'delegate_task': self.delegate_task,
+            'delegate_task_graph': self.delegate_task_graph,
             'summarize_agents_responses': self.summarize_agents_responses,
+            'merge_pending_reports': self.merge_pending_reports,
             'get_active_agents':self.get_active_agents,
             'retrieve_data_from_agents': self.retrieve_data_from_agents,
             'get_all_agents': self.get_all_agents
@@ -61,40 +93,89 @@ class AgentManager(AgentBase):
     #             print(f"Initialized {agent_key} agent.")
     #         else:
     #             print(f"No agent found for key: {agent_key}")
-    def set_agents(self, agent_keys):
+    def set_agents(self, agent_keys, reset_chat=True):
         """
-        Initialize and set the agents based on the provided agent keys, and then init the Gemini model.
+        Set the active agents based on the provided agent keys. Only the agent classes are registered here, an agent
+        is created the first time a task is delegated to it, and reused by later requests.
         If the code generator agent is in the agent_keys list, enable the code generator and disable all other agents.
+
+        Args:
+            agent_keys: keys of the agents to activate.
+            reset_chat: start reused agents with an empty chat history, like a freshly created agent.
         """
         self.code_generator_enabled = 'code_generator_agent' in agent_keys
+        if self.code_generator_enabled:
+            # Disable all other agents
+            agent_keys = ['code_generator_agent']
+            print("Code Generator Agent is enabled. All other agents are disabled.")
 
+        self.agents = {}
         for agent_key in agent_keys:
-            if agent_key == 'code_generator_agent':
-                if self.code_generator_enabled:
-                    agent_class = self.agent_classes.get(agent_key)
-                    if agent_class:
-                        self.agents[agent_key] = agent_class()
-                        print(f"Initialized {agent_key} agent.")
-                        # Disable all other agents
-                        self.agents = {agent_key: self.agents[agent_key]}
-                        print("Code Generator Agent is enabled. All other agents are disabled.")
-                        break
-                    else:
-                        print(f"No agent found for key: {agent_key}")
+            agent_class = self.agent_classes.get(agent_key)
+            if agent_class:
+                self.agents[agent_key] = agent_class
+                print(f"Registered {agent_key} agent.")
             else:
-                if not self.code_generator_enabled:
-                    agent_class = self.agent_classes.get(agent_key)
-                    if agent_class:
-                        self.agents[agent_key] = agent_class()
-                        print(f"Initialized {agent_key} agent.")
-                    else:
-                        print(f"No agent found for key: {agent_key}")
-
-
+                print(f"No agent found for key: {agent_key}")
+        # Reused agents get a fresh chat the first time they are used in this request
+        self.agents_to_reset = set(self.agents) if reset_chat else set()
 
+    def get_agent_instance(self, agent_key):
+        """
+        Return the instance for an active agent, creating it the first time it is needed.
+        Must be called from the manager's thread, before the agent is handed to a worker thread.
+        A reused agent's chat is reset by reset_if_needed(), once its worker holds the agent lock.
+        """
+        if agent_key in self.agent_instances:
+            agent = self.agent_instances[agent_key]
+            print(f"Reusing {agent_key} agent.")
+        else:
+            agent = self.agents[agent_key]()
+            self.agent_instances[agent_key] = agent
+            self.agents_to_reset.discard(agent_key)
+            print(f"Initialized {agent_key} agent.")
+        # The agent's report and debug messages belong to this manager's session
+        agent.output_root = self.output_root
+        agent.debug_room = self.debug_room
+        return agent
+
+    def reset_if_needed(self, agent_key):
+        # Called with the agent's lock held, a pending run from an earlier job may still be using the chat until then
+        if agent_key in self.agents_to_reset:
+            self.agents_to_reset.discard(agent_key)
+            self.agent_instances[agent_key].reset()
+
+    def create_agent_token(self):
+        """
+        A cancel token for one agent's run, cancelled with the job but owned by the manager once the agent is pending.
+        """
+        return self.cancel_token.child() if self.cancel_token is not None else CancelToken()
 
+    def cancel_pending_agents(self, reason, job_token=None):
+        """
+        Stop agents still running in the background, all of them or only those started by the job with job_token.
 
-         
+        Returns:
+            int: number of agents cancelled.
+        """
+        cancelled = 0
+        for agent, pending in list(self.pending_agents.items()):
+            if job_token is not None and pending['job_token'] is not job_token:
+                continue
+            if self.pending_agents.pop(agent, None) is None:
+                continue
+            pending['cancel_token'].cancel(reason)
+            cancelled += 1
+            print(f"MANAGER: Cancelled pending agent {agent}: {reason}")
+        self.timed_out_agents = list(self.pending_agents)
+        return cancelled
+
+    def reset_agents(self):
+        """
+        Clear the chat history of every cached agent instance.
+        """
+        for agent in self.agent_instances.values():
+            agent.reset()
 
     def get_all_agents(self):
         """
@@ -124,26 +205,396 @@ class AgentManager(AgentBase):
         if len(agents) != len(agent_instructions):
             return "Number of agents and instructions should be the same."
 
-        agent_responses = []
+        # Group instructions per agent so the same agent's chat is never used by two threads at once
+        agent_tasks = {}
         for agent, instruction in zip(agents, agent_instructions):
             print(f"MANAGER: DELEGATING to: {agent} with instruction: {instruction}")
             self.emit_debug_message(f"**AGENT MANAGER:** @{agent} {instruction}", "MANAGER AGENT")
             if agent in self.agents:
-                agent_response = self.agents[agent].generate_response(instruction)
-                self.data_store[f"{agent}"] = agent_response
-                agent_responses.append(f"{agent.capitalize()} Agent: {agent_response}")
+                agent_tasks.setdefault(agent, []).append(instruction)
             else:
-                agent_responses.append(f"No agent found for key: {agent}.")
+                print(f"No agent found for key: {agent}.")
 
-        self.delegated_agents = agents  # Update delegated_agents to include all the current agents
+        completed_agents, pending_agents = self.run_agents_in_parallel(agent_tasks)
+
+        self.delegated_agents = completed_agents  # Only agents that reported back are consolidated
+        self.timed_out_agents = pending_agents
 
         print(f"AGENT MANAGER: Delegated AGENTS:\n\n{self.delegated_agents}\n\n")
+        if self.timed_out_agents:
+            print(f"AGENT MANAGER: Pending AGENTS:\n\n{self.timed_out_agents}\n\n")
 
         response = self.summarize_agents_responses()
 
-        # return "\n".join(agent_responses)
         return response
 
+    def get_agent_lock(self, agent: str):
+        # Locks are created from the manager's thread before any worker starts, so no locking is needed here
+        if agent not in self.agent_locks:
+            self.agent_locks[agent] = threading.Lock()
+        return self.agent_locks[agent]
+
+    def get_output_folder(self):
+        output_folder = f"{self.output_root}/manager_agent"
+        os.makedirs(output_folder, exist_ok=True)
+        return output_folder
+
+    def agent_report_path(self, agent: str):
+        return f"{self.output_root}/{agent}/{RESPONSE}"
+
+    def read_agent_report(self, agent: str, started_at: float, fallback: str):
+        """
+        Read the report an agent wrote since started_at, or fall back to its chat response if it didn't write one.
+        """
+        report_path = self.agent_report_path(agent)
+        if os.path.exists(report_path) and os.path.getmtime(report_path) >= started_at:
+            return File.read_md(report_path)
+        return str(fallback)
+
+    def report_progress(self, agent: str, report: str):
+        if self.progress_callback is None:
+            return
+        try:
+            self.progress_callback(agent, report)
+        except Exception as e:
+            logging.error(f"Progress callback failed: {e}")
+
+    def condense_agent_report(self, agent: str, report: str, delegation: int):
+        """
+        Condense one agent's report while the other agents are still working, so the final
+        consolidation only has to merge short pieces. Executed on the agent's worker thread.
+        """
+        if delegation != self.delegation_id:
+            # Its delegation was consolidated already, the full report is used if it is merged later
+            return
+        self.emit_debug_message(f"**AGENT MANAGER:** Got the report from @{agent}, condensing it while the others finish...", "MANAGER AGENT")
+        prompt = f"""
+            You are helping the master agent prepare a final report for the user. Condense the report below from the {agent}
+            into its key findings, supporting numbers, notable quotes and conclusions that are relevant to the user input.
+            Keep it under 400 words and use markdown bullet points.
+
+            User Input: {self.user_input}
+
+            Report:
+
+            {report}
+        """
+        try:
+            condensed = self.pro_generate_analysis(prompt, raise_errors=True)
+        except AnalysisError as e:
+            # Without a condensed report the consolidation uses the agent's full report
+            logging.warning(f"Condensing the report of {agent} failed: {e}")
+            return
+        self.condensed_reports[agent] = {'delegation': delegation, 'report': condensed}
+
+    def run_agent(self, agent: str, instructions: List[str], cancel_token, delegation: int, condense: bool = False, cached_result=None):
+        """
+        Run every instruction assigned to one agent, in order, or restore its cached result. Executed on a worker thread.
+
+        Returns:
+            dict: the agent's chat response and its report.
+        """
+        agent_responses = []
+        started_at = time.time()
+        with self.agent_locks[agent]:
+            if agent in self.agent_instances:
+                # A tool call of the agent's previous run abandoned after its timeout could still overwrite the report
+                self.agent_instances[agent].cancel_token = cancel_token
+                self.agent_instances[agent].wait_for_abandoned_calls()
+            if cached_result:
+                # Put the cached report back where the consolidation step reads it
+                report_path = self.agent_report_path(agent)
+                os.makedirs(os.path.dirname(report_path), exist_ok=True)
+                File.write_md(cached_result['report'], report_path)
+                result = cached_result
+            else:
+                self.reset_if_needed(agent)
+                self.agent_instances[agent].deadline = self.agent_deadline()
+                self.agent_instances[agent].stream_callback = self.stream_callback
+                self.agent_instances[agent].degraded_reasons = []
+                for instruction in instructions:
+                    agent_responses.append(self.agent_instances[agent].generate_response(instruction))
+                response = "\n".join(str(response) for response in agent_responses)
+                result = {'response': response, 'report': self.read_agent_report(agent, started_at, response),
+                          'degraded': list(self.agent_instances[agent].degraded_reasons)}
+            self.report_progress(agent, result['report'])
+            if condense:
+                self.condense_agent_report(agent, result['report'], delegation)
+        return result
+
+    def agent_deadline(self):
+        """
+        The deadline agents work against: the request's deadline minus the time the manager needs to consolidate their reports.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline.shortened(CONSOLIDATION_TIME_RESERVE)
+
+    def agent_time_limit(self):
+        """
+        Seconds to wait for delegated agents, AGENT_TIMEOUT or less if the request's deadline is closer.
+        """
+        agent_deadline = self.agent_deadline()
+        if agent_deadline is None:
+            return AGENT_TIMEOUT
+        return max(min(AGENT_TIMEOUT, agent_deadline.remaining()), 1)
+
+    def get_cache_key(self, agent: str, instructions: List[str]):
+        return ResultCache.make_key(agent, [normalize_argument(instruction) for instruction in instructions])
+
+    def is_cacheable(self, agent: str, result: dict):
+        """
+        Only complete results are cached: a run cut short by the deadline or with a failed analysis or tool
+        would otherwise be served for the agent's whole cache_ttl.
+        """
+        if result.get('degraded'):
+            print(f"MANAGER: Not caching the partial result of {agent}: {', '.join(result['degraded'])}")
+            return False
+        # The active agents may have changed since the run started, so read the freshness window from the agent's class
+        return getattr(self.agent_classes.get(agent), 'cache_ttl', 0) > 0
+
+    def get_quorum(self, agent_count: int):
+        """
+        Number of agents that must report before the manager stops waiting for the slower ones.
+        """
+        return min(max(math.ceil(agent_count * DELEGATION_QUORUM), 1), agent_count)
+
+    def run_agents_in_parallel(self, agent_tasks: Dict[str, List[str]]):
+        """
+        Run all delegated agents at the same time and wait for them, until:
+        - every agent is done,
+        - a quorum of agents reported and the others had QUORUM_GRACE_PERIOD more seconds,
+        - DELEGATION_SOFT_TIMEOUT seconds passed and at least one agent reported,
+        - or AGENT_TIMEOUT seconds passed, less if the request's deadline leaves less time.
+        Agents that are still running are kept in pending_agents and finish in the background.
+        Agents with a fresh cached result for the same instructions are not run again.
+
+        Args:
+            agent_tasks: instructions for each agent, keyed by agent key.
+
+        Returns:
+            tuple: (agents that completed, agents still pending), both in delegation order.
+        """
+        if not agent_tasks:
+            return [], []
+
+        self.delegation_id += 1
+        delegation = self.delegation_id
+        cached_results = {}
+        for agent, instructions in agent_tasks.items():
+            self.get_agent_lock(agent)
+            if agent in self.pending_agents:
+                # The new run waits for the agent's lock, and its result replaces the pending one anyway
+                self.pending_agents.pop(agent)['cancel_token'].cancel("Replaced by a new delegation")
+            # Freshness windows are class attributes, so checking doesn't create the agent
+            cached_result = result_cache.get(self.get_cache_key(agent, instructions), self.agents[agent].cache_ttl)
+            if cached_result:
+                print(f"MANAGER: CACHE HIT for {agent}")
+                self.emit_debug_message(f"**AGENT MANAGER:** Cache hit, @{agent} answered this recently so I'm reusing its report.", "MANAGER AGENT")
+                cached_results[agent] = cached_result
+            else:
+                print(f"MANAGER: CACHE MISS for {agent}")
+                self.emit_debug_message(f"**AGENT MANAGER:** Cache miss for @{agent}, running it now.", "MANAGER AGENT")
+                self.get_agent_instance(agent)
+
+        # One worker per agent so every agent starts immediately and gets the full deadline
+        executor = ThreadPoolExecutor(max_workers=len(agent_tasks), thread_name_prefix="agent")
+        condense = INCREMENTAL_CONSOLIDATION and len(agent_tasks) > 1
+        self.condensed_reports = {}
+        agent_tokens = {agent: self.create_agent_token() for agent in agent_tasks}
+        futures = {agent: executor.submit(self.run_agent, agent, instructions, agent_tokens[agent], delegation, condense, cached_results.get(agent))
+                   for agent, instructions in agent_tasks.items()}
+        time_limit = self.agent_time_limit()
+        started_at = time.monotonic()
+        deadline = started_at + time_limit
+        soft_deadline = started_at + min(DELEGATION_SOFT_TIMEOUT, time_limit)
+        quorum = self.get_quorum(len(futures))
+        quorum_reached_at = None
+        # Wake up regularly so a cancelled request stops waiting right away
+        while not all(future.done() for future in futures.values()):
+            now = time.monotonic()
+            if now >= deadline or (self.cancel_token is not None and self.cancel_token.cancelled):
+                break
+            reported = sum(1 for future in futures.values() if future.done() and future.exception() is None)
+            if reported >= quorum:
+                quorum_reached_at = quorum_reached_at or now
+                if now >= quorum_reached_at + QUORUM_GRACE_PERIOD:
+                    print(f"MANAGER: QUORUM of {quorum} agents reached, not waiting for the others.")
+                    break
+            if reported and now >= soft_deadline:
+                print("MANAGER: SOFT DEADLINE passed, not waiting for the other agents.")
+                break
+            wait(futures.values(), timeout=min(CANCEL_POLL_INTERVAL, max(deadline - now, 0)))
+        # Don't block on agents that are still running, they finish in the background
+        executor.shutdown(wait=False)
+        self.check_cancelled()
+
+        completed_agents = []
+        pending_agents = []
+        for agent, future in futures.items():
+            if not future.done():
+                self.data_store[f"{agent}"] = f"{agent} is still working. Its report can be merged later with merge_pending_reports."
+                self.emit_debug_message(f"**AGENT MANAGER:** @{agent} is taking longer, I'll continue without its report for now and you can ask me to merge it once it's done.", "MANAGER AGENT")
+                self.pending_agents[agent] = {'future': future, 'instructions': agent_tasks[agent], 'cancel_token': agent_tokens[agent],
+                                              'job_token': self.cancel_token, 'delegation': delegation}
+                future.add_done_callback(lambda future, agent=agent: self.on_pending_agent_done(agent, future))
+                pending_agents.append(agent)
+            elif future.exception() is not None:
+                logging.error(f"Agent {agent} failed: {future.exception()}")
+                self.data_store[f"{agent}"] = f"{agent} failed with an error: {future.exception()}"
+                self.emit_debug_message(f"**AGENT MANAGER:** @{agent} ran into an error: {future.exception()}", "MANAGER AGENT")
+            else:
+                result = future.result()
+                self.data_store[f"{agent}"] = result['response']
+                self.report_delegations[agent] = delegation
+                completed_agents.append(agent)
+                if agent not in cached_results and self.is_cacheable(agent, result):
+                    result_cache.put(self.get_cache_key(agent, agent_tasks[agent]), result)
+                # A fresh result replaces a report still pending from an earlier delegation
+                self.pending_agents.pop(agent, None)
+
+        return completed_agents, pending_agents
+
+    def on_pending_agent_done(self, agent: str, future):
+        """
+        Called on the agent's worker thread when a pending agent finishes.
+        """
+        pending = self.pending_agents.get(agent)
+        if pending is None or pending['future'] is not future:
+            return
+        if future.exception() is not None:
+            logging.error(f"Pending agent {agent} failed: {future.exception()}")
+            return
+        if self.is_cacheable(agent, future.result()):
+            result_cache.put(self.get_cache_key(agent, pending['instructions']), future.result())
+        print(f"MANAGER: PENDING AGENT {agent} is done.")
+        self.emit_debug_message(f"**AGENT MANAGER:** @{agent} finished its report, ask me to merge it into the analysis.", "MANAGER AGENT")
+
+    def merge_pending_reports(self):
+        """Merge the reports of agents that were still working when the last analysis was written, and rewrite the analysis with them. Use it when the user asks for the late or missing reports.
+        Returns:
+            str: status of the merge
+        """
+        if not self.pending_agents:
+            return "There are no pending agent reports to merge."
+
+        finished_agents = [agent for agent, pending in self.pending_agents.items() if pending['future'].done()]
+        if not finished_agents:
+            return f"These agents are still working, try again later: {', '.join(self.pending_agents)}."
+
+        for agent in finished_agents:
+            pending = self.pending_agents.pop(agent)
+            future = pending['future']
+            if future.exception() is not None:
+                self.data_store[f"{agent}"] = f"{agent} failed with an error: {future.exception()}"
+                self.emit_debug_message(f"**AGENT MANAGER:** @{agent} ran into an error: {future.exception()}", "MANAGER AGENT")
+                continue
+            self.data_store[f"{agent}"] = future.result()['response']
+            self.report_delegations[agent] = pending['delegation']
+            if agent not in self.delegated_agents:
+                self.delegated_agents.append(agent)
+            self.emit_debug_message(f"**AGENT MANAGER:** Merging the report from @{agent}.", "MANAGER AGENT")
+
+        self.timed_out_agents = list(self.pending_agents)
+        return self.summarize_agents_responses()
+
+    def delegate_task_graph(self, agents: List[str], agent_instructions: List[str], depends_on: List[str]):
+        """Delegate tasks that depend on each other's findings. Tasks without dependencies run at the same time, and a task starts as soon as the tasks it depends on are done, receiving their reports.
+        Args:
+            agents: agent for each task. The same agent can appear more than once. Example: ['web_search_agent', 'reddit_agent']
+            agent_instructions: Instruction for each task. MUST match the length of agents list. All instructions must contain the context.
+            depends_on: For each task, comma separated 0-based indexes of the tasks whose findings it needs, or an empty string if it needs none. MUST match the length of agents list. Example: ['', '0'] means the reddit task waits for the web search findings.
+        Returns:
+            str: agents response
+        """
+        if DELEGATE_PROMPT_DEBUG:
+            print(f"TASK GRAPH ASSIGNED: {agents} with instructions: {agent_instructions} and dependencies: {depends_on}")
+            return "error"
+
+        try:
+            graph = TaskGraph(agents, agent_instructions, depends_on)
+        except TaskGraphError as e:
+            return str(e)
+
+        missing_agents = [agent for agent in agents if agent not in self.agents]
+        if missing_agents:
+            return f"No agent found for keys: {', '.join(missing_agents)}."
+
+        self.delegation_id += 1
+        delegation = self.delegation_id
+        # Tasks that time out aren't merged later, they are stopped once the graph is done
+        graph_token = self.create_agent_token()
+        for node in graph.nodes:
+            node['delegation'] = delegation
+            node['cancel_token'] = graph_token
+            if node['agent'] in self.pending_agents:
+                self.pending_agents.pop(node['agent'])['cancel_token'].cancel("Replaced by a new delegation")
+            node['is_last_for_agent'] = node['id'] == max(other['id'] for other in graph.nodes if other['agent'] == node['agent'])
+            node['multiple_agents'] = len(set(agents)) > 1
+            self.get_agent_lock(node['agent'])
+            self.get_agent_instance(node['agent'])
+            waiting_for = f" (after tasks {node['depends_on']})" if node['depends_on'] else ""
+            print(f"MANAGER: TASK {node['id']}: {node['agent']} with instruction: {node['instruction']}{waiting_for}")
+            self.emit_debug_message(f"**AGENT MANAGER:** Task {node['id']}: @{node['agent']} {node['instruction']}{waiting_for}", "MANAGER AGENT")
+
+        self.condensed_reports = {}
+        # Each node gets AGENT_TIMEOUT from its start, but a chain of tasks must still end by the request's deadline
+        try:
+            outcomes = graph.run(self.run_task_node, AGENT_TIMEOUT, self.cancel_token, self.agent_deadline())
+        finally:
+            graph_token.cancel("The task graph finished without it")
+
+        completed_agents = []
+        timed_out_agents = []
+        for node in graph.nodes:
+            agent = node['agent']
+            outcome = outcomes[node['id']]
+            if outcome['status'] == 'completed':
+                self.data_store[f"{agent}"] = outcome['result']['response']
+                self.report_delegations[agent] = delegation
+                if agent not in completed_agents:
+                    completed_agents.append(agent)
+            else:
+                self.data_store[f"{agent}"] = f"Task {node['id']} ({agent}) {outcome['status']}: {outcome['error']}"
+                self.emit_debug_message(f"**AGENT MANAGER:** Task {node['id']} for @{agent} {outcome['status'].replace('_', ' ')}.", "MANAGER AGENT")
+                if outcome['status'] == 'timed_out' and agent not in timed_out_agents:
+                    timed_out_agents.append(agent)
+
+        self.delegated_agents = completed_agents
+        self.timed_out_agents = [agent for agent in timed_out_agents if agent not in completed_agents]
+
+        print(f"AGENT MANAGER: Delegated AGENTS:\n\n{self.delegated_agents}\n\n")
+
+        return self.summarize_agents_responses()
+
+    def run_task_node(self, node, inputs):
+        """
+        Run one task graph node, giving it the findings of the tasks it depends on. Executed on a worker thread.
+        """
+        instruction = node['instruction']
+        if inputs:
+            findings = "\n\n".join(f"Findings from task {dependency}:\n{result['report']}" for dependency, result in inputs.items())
+            instruction = f"{instruction}\n\nUse these findings from other agents as context:\n\n{findings}"
+
+        agent = node['agent']
+        started_at = time.time()
+        with self.agent_locks[agent]:
+            self.agent_instances[agent].cancel_token = node['cancel_token']
+            self.agent_instances[agent].wait_for_abandoned_calls()
+            self.reset_if_needed(agent)
+            self.agent_instances[agent].deadline = self.agent_deadline()
+            self.agent_instances[agent].stream_callback = self.stream_callback
+            response = self.agent_instances[agent].generate_response(instruction)
+            # Capture the report now, a later task for the same agent overwrites the file
+            report = self.read_agent_report(agent, started_at, response)
+            self.report_progress(agent, report)
+            # The agent's last task in the graph provides its final report
+            if INCREMENTAL_CONSOLIDATION and node['is_last_for_agent'] and node['multiple_agents']:
+                self.condense_agent_report(agent, report, node['delegation'])
+
+        self.emit_debug_message(f"**AGENT MANAGER:** Task {node['id']} for @{agent} is done.", "MANAGER AGENT")
+        return {'response': response, 'report': report}
+
     def summarize_agents_responses(self):
         """
             Summarize all agents' responses AFTER they generated analysis.
@@ -155,10 +606,11 @@ class AgentManager(AgentBase):
         """
         # print("MANAGER AGENT: ATTEMPTING TO SUMMARIZE...")
         instruction = "You are the master agent that handles user input and delegates tasks to other agents. Now that all agents have completed their tasks, based on all agents' responses below, write a detailed analysis, summarize and make a conclusion as a response to back to the user."
+        response_path = self.get_response_path()
         self.emit_debug_message(f"**AGENT MANAGER:** Received reports from all agents. Consolidating everything now...", "MANAGER AGENT")
         agent_responses = []
         for agent in self.delegated_agents:
-            response_file_path = f"output/{agent}/{RESPONSE}"
+            response_file_path = self.agent_report_path(agent)
             if os.path.exists(response_file_path):
                 # with open(response_file_path, 'r') as file:
                 #     response_data = json.load(file)
@@ -178,11 +630,37 @@ class AgentManager(AgentBase):
             File.write_md(agent_response, response_path)
             return f"Analysis generated by MANAGER AGENT, and it is available at {response_path}"
         else:
+            # Every report was condensed as it arrived, so only merge the condensed pieces
+            if INCREMENTAL_CONSOLIDATION and all(agent in self.condensed_reports and self.condensed_reports[agent]['delegation'] == self.report_delegations.get(agent)
+                                                 for agent in self.delegated_agents):
+                print("MANAGER AGENT: Merging condensed reports...")
+                agent_responses = [self.condensed_reports[agent]['report'] for agent in self.delegated_agents]
+
+            # Reports too large for one prompt are condensed first, each report gets an equal share of the budget
+            target_tokens = min(MAP_REDUCE_TARGET_TOKENS, self.analysis_token_budget() - self.estimate_tokens(instruction) - self.estimate_tokens(self.user_input))
+            if sum(self.estimate_tokens(response) for response in agent_responses) > target_tokens:
+                self.emit_debug_message("**AGENT MANAGER:** The reports are very long, condensing them first...", "MANAGER AGENT")
+                share = target_tokens // len(agent_responses)
+
+                async def condense_report(report):
+                    try:
+                        return await self.amap_reduce_summarize([report], self.user_input, target_tokens=share)
+                    except AnalysisError:
+                        # Keep the start of the report rather than dropping it
+                        return report[:share * 4]
+
+                async def condense_reports(reports):
+                    return await asyncio.gather(*(condense_report(report) for report in reports))
+
+                agent_responses = run_sync(condense_reports(agent_responses))
+
             prompt = f"{instruction}\n\nUser Input: {self.user_input}\n\nAgent Responses:\n"
             for i, response in enumerate(agent_responses, start=1):
                 prompt += f"Agent {i}: {response}\n"
+            if self.timed_out_agents:
+                prompt += f"\nNote: these agents have not reported back yet and are not included above, their findings may be added later: {', '.join(self.timed_out_agents)}\n"
 
-            summary_text = self.pro_generate_analysis(prompt)
+            summary_text = self.pro_generate_analysis(prompt, response_path)
             File.write_md(summary_text, response_path)
             self.data_store[f"manager_agent"] = summary_text
             self.emit_debug_message(f"**AGENT MANAGER:** Ok, done!", "MANAGER AGENT")
@@ -201,7 +679,7 @@ class AgentManager(AgentBase):
         """
         agent_responses = {}
         for agent in agents:
-            response_file_path = f"output/{agent}/{RESPONSE}"
+            response_file_path = self.agent_report_path(agent)
             if os.path.exists(response_file_path):
                 response_data = File.read_md(response_file_path)
                 agent_responses[agent] = response_data
@@ -224,11 +702,19 @@ class AgentManager(AgentBase):
     
     def generate_response(self, user_prompt):
         if self.code_generator_enabled:
-            code_generator = self.agents["code_generator_agent"]
-            code_generator.set_user_prompt(user_prompt)
-            response = code_generator.generate_response(user_prompt)
-
-            all_agents_response_md = self.get_md_files("output")
+            code_generator = self.get_agent_instance("code_generator_agent")
+            with self.get_agent_lock("code_generator_agent"):
+                code_generator.cancel_token = self.cancel_token
+                code_generator.wait_for_abandoned_calls()
+                # Starts with a clean chat like the delegated agents
+                self.reset_if_needed("code_generator_agent")
+                # Nothing to consolidate, it gets the whole deadline
+                code_generator.deadline = self.deadline
+                code_generator.stream_callback = self.stream_callback
+                code_generator.set_user_prompt(user_prompt)
+                response = code_generator.generate_response(user_prompt)
+
+            all_agents_response_md = self.get_md_files(self.output_root)
 
             return response, all_agents_response_md
         else:
@@ -238,7 +724,7 @@ class AgentManager(AgentBase):
             if self.first_conversation:
                 agent_descriptions = []
                 for agent_key in self.get_active_agents():
-                    agent = self.agents[agent_key]
+                    agent = self.agents[agent_key]  # descriptions are class attributes, no need to create the agent
                     description = getattr(agent, 'description', f"No description available for {agent_key} agent.")
                     agent_descriptions.append(f"- {agent_key}: {description}")
 
@@ -249,8 +735,12 @@ class AgentManager(AgentBase):
 
                         You can delegate to more than 1 agent. For example, if asked anything about game reviews, you can delegate to both steam and reddit agents. Once the delegation is complete, you can inform the user where is the file saved.
 
+                        If an agent needs another agent's findings first (for example, search the web first and then look for those topics on reddit), use delegate_task_graph in a single call instead of delegating one agent at a time.
+
                         If user asks follow up questions about the analysis or summary, you can retrieve_data_from_agents directly without delegating any agents.
 
+                        If some agents were still working when you answered, the user can ask for their reports later, use merge_pending_reports for that instead of delegating again.
+
                         User: {user_prompt}
                     """
                 self.first_conversation = False
@@ -260,7 +750,7 @@ class AgentManager(AgentBase):
             # logging.debug(f"Generating response using the following prompt:\n{prompt}")
             response = self.execute_function_sequence(self.model, self.functions, prompt, self.chat)
 
-            all_agents_response_md = self.get_md_files("output")
+            all_agents_response_md = self.get_md_files(self.output_root)
 
             print("ALL AGENTS RESPONSE:\n\n\n")
             print(all_agents_response_md)
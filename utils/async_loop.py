@@ -0,0 +1,39 @@
+import asyncio
+import threading
+
+# One event loop for the whole process. Async gRPC clients are bound to the loop they were created on,
+# so every async agent run goes through this loop instead of a fresh asyncio.run() per call.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Return the shared event loop, starting it on a daemon thread the first time it is needed.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="agent-event-loop", daemon=True)
+            thread.start()
+    return _loop
+
+
+def run_sync(coroutine, timeout=None):
+    """
+    Run a coroutine on the shared event loop and block the calling thread until it is done.
+
+    Args:
+        coroutine: the coroutine to run.
+        timeout (float): maximum seconds to wait, or None to wait forever.
+
+    Returns:
+        The coroutine's result.
+    """
+    loop = get_event_loop()
+    if threading.current_thread().name == "agent-event-loop":
+        coroutine.close()
+        raise RuntimeError("run_sync() cannot be called from the shared event loop, await the coroutine instead.")
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    return future.result(timeout)
@@ -0,0 +1,90 @@
+import threading
+
+# How often blocking waits check whether they were cancelled
+CANCEL_POLL_INTERVAL = 0.2
+
+
+class TaskCancelled(BaseException):
+    """
+    Raised when a request is cancelled. Like asyncio.CancelledError it derives from BaseException,
+    so the `except Exception` blocks in agents' fetch loops don't swallow it.
+    """
+    pass
+
+
+class CancelToken:
+    """
+    Cooperative cancellation flag shared by everything working on one request. The owner calls cancel(),
+    and long running work calls raise_if_cancelled() between steps.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.lock = threading.Lock()
+        self.children = []
+
+    def cancel(self, reason="Cancelled"):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            children = self.children
+            self.children = []
+        for child in children:
+            child.cancel(reason)
+
+    def child(self):
+        """
+        A token that is cancelled along with this one, and can also be cancelled on its own,
+        e.g. for work that may outlive the request that started it.
+        """
+        child = CancelToken()
+        with self.lock:
+            if not self.event.is_set():
+                self.children.append(child)
+                return child
+        child.cancel(self.reason)
+        return child
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise TaskCancelled(self.reason)
+
+    def wait(self, timeout=None):
+        """
+        Sleep until cancelled or timeout. Returns True if cancelled.
+        """
+        return self.event.wait(timeout)
+
+
+def call_cancellable(cancel_token, function, *args, **kwargs):
+    """
+    Run a blocking call on a helper thread and return its result, but give up as soon as cancel_token
+    is cancelled. The abandoned call finishes in the background and its result is discarded.
+    """
+    if cancel_token is None:
+        return function(*args, **kwargs)
+    cancel_token.raise_if_cancelled()
+
+    outcome = {}
+    done = threading.Event()
+
+    def run():
+        try:
+            outcome['result'] = function(*args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=run, name="cancellable-call", daemon=True).start()
+    while not done.wait(CANCEL_POLL_INTERVAL):
+        cancel_token.raise_if_cancelled()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
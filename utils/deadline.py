@@ -0,0 +1,34 @@
+import time
+
+
+class Deadline:
+    """
+    A point in time a request must be answered by. It is passed from /api through the manager to every
+    agent, and agents size their work (posts, pages, reviews, model) to what still fits.
+    """
+    def __init__(self, expires_at):
+        """
+        Args:
+            expires_at (float): time.monotonic() value the deadline expires at.
+        """
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds):
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self):
+        """
+        Seconds left, never negative.
+        """
+        return max(self.expires_at - time.monotonic(), 0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def shortened(self, seconds):
+        """
+        A deadline that expires `seconds` earlier, e.g. to leave the manager time to consolidate after its agents.
+        """
+        return Deadline(self.expires_at - seconds)
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+import google.ai.generativelanguage as glm
+from google.generativeai.types import generation_types
+from utils.llm_backend import LLMBackend
+from utils.prompt_budget import estimate_tokens
+
+# Words per streamed chunk
+FAKE_STREAM_CHUNK_WORDS = 20
+
+
+def to_contents(contents):
+    """
+    Normalize what callers pass to generate_content or send_message (text, parts, contents or a list of them)
+    into a list of glm.Content.
+    """
+    if isinstance(contents, (str, glm.Part, glm.Content)):
+        contents = [contents]
+    contents = list(contents)
+    if all(isinstance(content, glm.Content) for content in contents):
+        return contents
+    parts = [glm.Part(text=part) if isinstance(part, str) else part for part in contents]
+    return [glm.Content(role='user', parts=parts)]
+
+
+class FakeTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic local LLM for benchmarking orchestration without a network or quota. Every call sleeps
+    latency + seconds_per_token * output tokens, streamed answers are split in chunks over that time.
+
+    Function calling is emulated with tool_calls: when a prompt is sent to a model that declares one of these
+    tools, the model answers with calls to them, and once it gets the function responses it answers with text.
+    """
+    def __init__(self, latency, output_tokens, seconds_per_token, tool_calls=None):
+        """
+        Args:
+            latency (float): seconds every call takes before the first token.
+            output_tokens (int): length of every text answer.
+            seconds_per_token (float): generation time per output token.
+            tool_calls (dict): tool name -> arguments, or a function that returns the arguments for the prompt text.
+        """
+        self.latency = latency
+        self.output_tokens = output_tokens
+        self.seconds_per_token = seconds_per_token
+        self.tool_calls = tool_calls or {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.simulated_seconds = 0
+
+    def create_model(self, model_name, tools=None, safety_settings=None):
+        return FakeModel(self, model_name, tools)
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'prompt_tokens': self.prompt_tokens, 'simulated_seconds': self.simulated_seconds}
+
+    def reply(self, model, contents):
+        """
+        The model's answer to contents, and the seconds it takes.
+        """
+        last = contents[-1]
+        prompt = " ".join(part.text for part in last.parts if part.text)
+        if last.role == 'user' and prompt and model.tool_names:
+            calls = []
+            for name, arguments in self.tool_calls.items():
+                if name in model.tool_names:
+                    arguments = arguments(prompt) if callable(arguments) else arguments
+                    calls.append(glm.Part(function_call=glm.FunctionCall(name=name, args=arguments)))
+            if calls:
+                return glm.Content(role='model', parts=calls), self.latency
+
+        called = [part.function_response.name for part in last.parts if part.function_response]
+        if called:
+            text = f"Done, {', '.join(called)} completed."
+        else:
+            words = " ".join(f"token{index}" for index in range(self.output_tokens))
+            text = f"# Fake answer\n\nAnswer to a prompt of {sum(estimate_tokens(str(content)) for content in contents)} tokens.\n\n{words}"
+        return glm.Content(role='model', parts=[glm.Part(text=text)]), self.latency + self.output_tokens * self.seconds_per_token
+
+    def record(self, contents, seconds):
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += sum(estimate_tokens(str(content)) for content in contents)
+            self.simulated_seconds += seconds
+
+
+def build_response(content, finish=True):
+    candidate = glm.Candidate(content=content, index=0)
+    if finish:
+        candidate.finish_reason = glm.Candidate.FinishReason.STOP
+    return glm.GenerateContentResponse(candidates=[candidate])
+
+
+def split_reply(content, seconds):
+    """
+    Split a text answer in chunks, with the time to wait before each one.
+    """
+    if not content.parts or not content.parts[0].text:
+        return [(content, seconds)]
+    words = content.parts[0].text.split(" ")
+    pieces = [" ".join(words[index:index + FAKE_STREAM_CHUNK_WORDS]) for index in range(0, len(words), FAKE_STREAM_CHUNK_WORDS)]
+    pieces = [piece if index == len(pieces) - 1 else f"{piece} " for index, piece in enumerate(pieces)]
+    delay = seconds / len(pieces)
+    return [(glm.Content(role='model', parts=[glm.Part(text=piece)]), delay) for piece in pieces]
+
+
+class FakeModel:
+    def __init__(self, backend, model_name, tools=None):
+        self.backend = backend
+        self.model_name = f"models/{model_name.split('/')[-1]}"
+        self.tool_names = [tool.__name__ for tool in tools or []]
+
+    def generate_content(self, contents, safety_settings=None, stream=False, **kwargs):
+        contents = to_contents(contents)
+        content, seconds = self.backend.reply(self, contents)
+        self.backend.record(contents, seconds)
+        if not stream:
+            time.sleep(seconds)
+            return generation_types.GenerateContentResponse.from_response(build_response(content))
+
+        chunks = split_reply(content, seconds)
+
+        def iterate():
+            for index, (chunk, delay) in enumerate(chunks):
+                time.sleep(delay)
+                yield build_response(chunk, index == len(chunks) - 1)
+
+        return generation_types.GenerateContentResponse.from_iterator(iterate())
+
+    async def generate_content_async(self, contents, safety_settings=None, stream=False, **kwargs):
+        contents = to_contents(contents)
+        content, seconds = self.backend.reply(self, contents)
+        self.backend.record(contents, seconds)
+        if not stream:
+            await asyncio.sleep(seconds)
+            return generation_types.AsyncGenerateContentResponse.from_response(build_response(content))
+
+        chunks = split_reply(content, seconds)
+
+        async def iterate():
+            for index, (chunk, delay) in enumerate(chunks):
+                await asyncio.sleep(delay)
+                yield build_response(chunk, index == len(chunks) - 1)
+
+        return await generation_types.AsyncGenerateContentResponse.from_aiterator(iterate())
+
+    def count_tokens(self, contents):
+        return FakeTokenCount(sum(estimate_tokens(str(content)) for content in to_contents(contents)))
+
+    def start_chat(self, history=None, **kwargs):
+        return FakeChatSession(self, history)
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, **kwargs):
+        message = to_contents(content)
+        response = self.model.generate_content(self.history + message)
+        self.history = self.history + message + [response.candidates[0].content]
+        return response
+
+    async def send_message_async(self, content, **kwargs):
+        message = to_contents(content)
+        response = await self.model.generate_content_async(self.history + message)
+        self.history = self.history + message + [response.candidates[0].content]
+        return response
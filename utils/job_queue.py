@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from utils.cancellation import CancelToken, TaskCancelled
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id, function, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        # Passed down to the agents running this job so a cancelled job stops its work
+        self.cancel_token = CancelToken()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job is finished. Returns True if it finished within timeout.
+        """
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on a fixed number of worker threads. Admission is bounded: submit() raises QueueFullError
+    when the queue, or the user's share of it, is full, so callers can reject right away instead of
+    piling up. Workers take jobs round robin across users so one user's burst can't starve everyone else,
+and a user's jobs run one at a time (they share the user's session), so they can't tie up every worker.
+    """
+    def __init__(self, worker_count, max_queued, max_queued_per_user, max_finished=200, on_status_change=None):
+        """
+        Args:
+            worker_count (int): number of jobs running at the same time.
+            max_queued (int): maximum number of jobs waiting for a worker.
+            max_queued_per_user (int): maximum number of jobs one user can have waiting.
+            max_finished (int): number of finished jobs kept for lookups.
+            on_status_change (callable): called with the job every time its status changes.
+        """
+        self.on_status_change = on_status_change
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_finished = max_finished
+        self.user_queues = OrderedDict()
+        self.jobs = OrderedDict()
+        self.queued_count = 0
+        # Users with a job on a worker, their next job waits until it finishes
+        self.running_users = set()
+        self.condition = threading.Condition()
+        for index in range(worker_count):
+            threading.Thread(target=self.worker, name=f"job-worker-{index}", daemon=True).start()
+
+    def submit(self, user_id, function, *args, **kwargs):
+        """
+        Queue function(job, *args, **kwargs) for user_id. The function receives its own Job first,
+        e.g. to report progress under the job id.
+
+        Returns:
+            Job: the queued job.
+
+        Raises:
+            QueueFullError: the queue or the user's share of it is full.
+        """
+        with self.condition:
+            user_queue = self.user_queues.get(user_id)
+            if self.queued_count >= self.max_queued:
+                raise QueueFullError("The server is busy, please try again shortly.")
+            if user_queue is not None and len(user_queue) >= self.max_queued_per_user:
+                raise QueueFullError("You already have too many requests waiting, please wait for them to finish.")
+
+            job = Job(user_id, function, args, kwargs)
+            self.user_queues.setdefault(user_id, deque()).append(job)
+            self.jobs[job.id] = job
+            self.queued_count += 1
+            self.prune_finished_jobs()
+            # Notified before a worker can pick it up, so listeners always see 'queued' first
+            self.notify_status_change(job)
+            self.condition.notify()
+            return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id, reason="Cancelled by user"):
+        """
+        Cancel a job. A queued job is removed from the queue, a running job is asked to stop through its cancel token.
+
+        Returns:
+            bool: False if the job doesn't exist or already finished.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.done.is_set():
+                return False
+            job.cancel_token.cancel(reason)
+            if job.status != 'queued':
+                return True
+            user_queue = self.user_queues.get(job.user_id)
+            user_queue.remove(job)
+            if not user_queue:
+                del self.user_queues[job.user_id]
+            self.queued_count -= 1
+            job.status = 'cancelled'
+            job.error = reason
+            job.finished_at = time.time()
+            job.done.set()
+            self.notify_status_change(job)
+            return True
+
+    def cancel_user_jobs(self, user_id, reason="Cancelled by user"):
+        """
+        Cancel every unfinished job of a user.
+
+        Returns:
+            int: number of jobs cancelled.
+        """
+        with self.condition:
+            job_ids = [job.id for job in self.jobs.values() if job.user_id == user_id and not job.done.is_set()]
+        return sum(1 for job_id in job_ids if self.cancel(job_id, reason))
+
+    def queued_jobs(self):
+        with self.condition:
+            return self.queued_count
+
+    def next_job(self):
+        # Called with self.condition held. Take the oldest job of the next user without a running job and move
+        # the user to the back. None if every waiting user already has a job running
+        user_id = next((user_id for user_id in self.user_queues if user_id not in self.running_users), None)
+        if user_id is None:
+            return None
+        user_queue = self.user_queues.pop(user_id)
+        job = user_queue.popleft()
+        if user_queue:
+            self.user_queues[user_id] = user_queue
+        self.queued_count -= 1
+        self.running_users.add(user_id)
+        return job
+
+    def notify_status_change(self, job):
+        if self.on_status_change is None:
+            return
+        try:
+            self.on_status_change(job)
+        except Exception as e:
+            logging.error(f"Job status listener failed: {e}")
+
+    def prune_finished_jobs(self):
+        # Called with self.condition held
+        finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    def worker(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self.next_job()
+                job.status = 'running'
+                job.started_at = time.time()
+            self.notify_status_change(job)
+
+            try:
+                job.result = job.function(job, *job.args, **job.kwargs)
+                job.status = 'done'
+            except TaskCancelled as e:
+                logging.info(f"Job {job.id} cancelled: {e}")
+                job.error = str(e)
+                job.status = 'cancelled'
+            except Exception as e:
+                logging.error(f"Job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished_at = time.time()
+                job.done.set()
+                with self.condition:
+                    self.running_users.discard(job.user_id)
+                    # The user's next job may be waiting for this one
+                    self.condition.notify_all()
+            self.notify_status_change(job)
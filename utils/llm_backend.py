@@ -0,0 +1,71 @@
+from abc import ABC, abstractmethod
+import os
+import threading
+import google.generativeai as genai
+from app_constants import LLM_BACKEND, FAKE_LLM_LATENCY, FAKE_LLM_OUTPUT_TOKENS, FAKE_LLM_SECONDS_PER_TOKEN
+
+
+class LLMBackend(ABC):
+    """
+    Where LLM calls go. A backend creates model objects with the part of the GenerativeModel interface the agents use:
+    model_name, generate_content(contents, safety_settings=None, stream=False), generate_content_async (same arguments),
+    count_tokens(contents) and start_chat(history=None). Chats have history, send_message and send_message_async.
+    Messages are glm.Content and glm.Part objects for every backend.
+    """
+    @abstractmethod
+    def create_model(self, model_name, tools=None, safety_settings=None):
+        pass
+
+
+class GeminiBackend(LLMBackend):
+    def __init__(self):
+        self.configured = False
+        self.lock = threading.Lock()
+
+    def configure(self):
+        # Done on first use instead of at import, so modules can be imported without an API key
+        with self.lock:
+            if not self.configured:
+                genai.configure(api_key=os.environ["API_KEY"])
+                self.configured = True
+
+    def create_model(self, model_name, tools=None, safety_settings=None):
+        self.configure()
+        return genai.GenerativeModel(model_name=model_name, tools=tools, safety_settings=safety_settings)
+
+
+def create_backend(name):
+    """
+    Args:
+        name (str): 'gemini', or 'fake' for the local fake used for benchmarks (see utils/fake_llm.py).
+    """
+    if name == 'gemini':
+        return GeminiBackend()
+    if name == 'fake':
+        from utils.fake_llm import FakeBackend
+        return FakeBackend(FAKE_LLM_LATENCY, FAKE_LLM_OUTPUT_TOKENS, FAKE_LLM_SECONDS_PER_TOKEN)
+    raise ValueError(f"Unknown LLM backend: {name}")
+
+
+backend = None
+backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    The backend every model is created with, chosen by the LLM_BACKEND environment variable or constant.
+    """
+    global backend
+    with backend_lock:
+        if backend is None:
+            backend = create_backend(os.environ.get("LLM_BACKEND", LLM_BACKEND))
+        return backend
+
+
+def set_backend(new_backend):
+    """
+    Replace the backend, e.g. with a configured FakeBackend in a benchmark. Models created before keep their backend.
+    """
+    global backend
+    with backend_lock:
+        backend = new_backend
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class LLMCache:
+    """
+    Persistent cache of LLM responses. Entries are content addressed: the key is a hash of the model, its settings
+    and the prompt, and every entry is its own file named after the key. The folder is kept under max_bytes by
+    evicting the least recently used entries, and callers pass the freshness window (ttl) when reading.
+    """
+    def __init__(self, folder, max_bytes, default_ttl):
+        """
+        Args:
+            folder (str): folder the entries are stored in.
+            max_bytes (int): the least recently used entries are dropped beyond this total size.
+            default_ttl (int): seconds an entry stays fresh when get() is called without a ttl.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> {'size': bytes, 'accessed_at': time}, rebuilt from the files so the LRU order survives restarts
+        self.index = {}
+        self.total_bytes = 0
+        self.load_index()
+
+    def load_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                self.index[entry.name[:-len('.json')]] = {'size': stat.st_size, 'accessed_at': stat.st_mtime}
+                self.total_bytes += stat.st_size
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    @staticmethod
+    def make_key(model_name, settings, prompt):
+        content = json.dumps([model_name.split('/')[-1], settings, str(prompt)], sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key, ttl=None):
+        """
+        Return the cached text for key if it is younger than ttl seconds, otherwise None.
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        with self.lock:
+            if ttl <= 0 or key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(key), 'r', encoding='utf-8') as file:
+                    entry = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                self.remove(key)
+                self.misses += 1
+                return None
+            if time.time() - entry['created_at'] > ttl:
+                self.misses += 1
+                return None
+            now = time.time()
+            self.index[key]['accessed_at'] = now
+            os.utime(self.path(key), (now, now))
+            self.hits += 1
+            return entry['value']
+
+    def put(self, key, value):
+        data = json.dumps({'created_at': time.time(), 'value': value}, ensure_ascii=False)
+        with self.lock:
+            # Write to a temporary file first so a crash never leaves a half written entry
+            temp_path = f"{self.path(key)}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                file.write(data)
+            os.replace(temp_path, self.path(key))
+            size = os.path.getsize(self.path(key))
+            self.total_bytes += size - self.index.get(key, {}).get('size', 0)
+            self.index[key] = {'size': size, 'accessed_at': time.time()}
+            self.evict()
+
+    def evict(self):
+        # Called with self.lock held
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.index, key=lambda entry_key: self.index[entry_key]['accessed_at']):
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.remove(key)
+            self.evictions += 1
+
+    def remove(self, key):
+        # Called with self.lock held
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'entries': len(self.index),
+                'bytes': self.total_bytes
+            }
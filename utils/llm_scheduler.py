@@ -0,0 +1,283 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from google.api_core import exceptions as google_exceptions
+from utils.cancellation import CANCEL_POLL_INTERVAL
+from utils.resilience import resilience, retry_after, sleep
+from app_constants import LLM_RATE_LIMITS, DEFAULT_LLM_RATE_LIMIT, LLM_RATE_LIMIT_PAUSE
+
+# Lower values are served first
+PRIORITY_MANAGER = 0  # the manager's consolidation, the user is waiting on it
+PRIORITY_CHAT = 1  # chat turns and function calling
+PRIORITY_BULK = 2  # agents' analyses and map-reduce chunk summaries
+
+
+class PromptTooLargeError(ValueError):
+    """
+    A call needs more tokens than the model's whole per-minute limit, it could never be admitted.
+    AgentBase.fit_prompt keeps prompts below the limit.
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Refills continuously up to `capacity` per minute.
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until `amount` can be taken, 0 if it can be taken now.
+        """
+        needed = amount - self.available
+        return max(needed / self.rate, 0)
+
+    def take(self, amount):
+        self.available -= amount
+
+
+class ModelLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        # Set when the API answered 429, nothing is sent to this model before then
+        self.paused_until = 0
+        # Heap of (priority, arrival order) for callers waiting on this model
+        self.waiting = []
+
+    def wait_time(self, tokens, now):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens), self.paused_until - now, 0)
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control for Gemini calls. Every model has a requests-per-minute and a
+    tokens-per-minute bucket, and callers wait in a priority queue until their call fits, so parallel
+    agents share the quota instead of each running into 429 errors. Calls that still get a 429 pause
+    the model and are queued again.
+    """
+    def __init__(self, rate_limits, default_rate_limit):
+        """
+        Args:
+            rate_limits (dict): model name -> (requests per minute, tokens per minute).
+            default_rate_limit (tuple): limits for models not in rate_limits.
+        """
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.limiters = {}
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        # (event loop, future) of coroutines waiting in aacquire, resolved by wake_all
+        self.async_waiters = set()
+
+    def get_limiter(self, model_name):
+        # Called with self.condition held. "models/gemini-1.5-pro-latest" and "gemini-1.5-pro-latest" share a limiter
+        model_name = model_name.split('/')[-1]
+        if model_name not in self.limiters:
+            self.limiters[model_name] = ModelLimiter(*self.rate_limits.get(model_name, self.default_rate_limit))
+        return self.limiters[model_name]
+
+    def tokens_per_minute(self, model_name):
+        """
+        The model's tokens-per-minute limit, the largest call it can admit.
+        """
+        return self.rate_limits.get(model_name.split('/')[-1], self.default_rate_limit)[1]
+
+    def check_size(self, model_name, tokens):
+        """
+        Raises:
+            PromptTooLargeError: the call is larger than the model's tokens-per-minute limit.
+        """
+        if tokens > self.tokens_per_minute(model_name):
+            raise PromptTooLargeError(f"A call of {tokens} tokens is larger than the {self.tokens_per_minute(model_name)} tokens per minute of {model_name}.")
+
+    def try_take(self, limiter, ticket, tokens):
+        """
+        Called with self.condition held. Take capacity for ticket if it is first in line and the call fits.
+
+        Returns:
+            tuple: (whether capacity was taken, seconds until it may fit or None if other callers are ahead)
+        """
+        wait_time = limiter.wait_time(tokens, time.monotonic())
+        # Only the first caller in line may take capacity, so a large bulk call isn't starved by small ones
+        if limiter.waiting[0] != ticket:
+            return False, None
+        if wait_time <= 0:
+            limiter.requests.take(1)
+            limiter.tokens.take(tokens)
+            return True, 0
+        return False, wait_time
+
+    def wake_all(self):
+        # Called with self.condition held. Wakes blocked threads and coroutines so they check their ticket again
+        self.condition.notify_all()
+        for loop, waker in self.async_waiters:
+            loop.call_soon_threadsafe(self.set_waker, waker)
+
+    @staticmethod
+    def set_waker(waker):
+        if not waker.done():
+            waker.set_result(None)
+
+    def release(self, limiter, ticket):
+        with self.condition:
+            limiter.waiting.remove(ticket)
+            heapq.heapify(limiter.waiting)
+            self.wake_all()
+
+    def acquire(self, model_name, tokens, priority=PRIORITY_BULK, cancel_token=None):
+        """
+        Block until a call of `tokens` prompt tokens may be sent to model_name.
+
+        Raises:
+            TaskCancelled: cancel_token was cancelled while waiting.
+            PromptTooLargeError: the call could never fit, see check_size().
+        """
+        self.check_size(model_name, tokens)
+        with self.condition:
+            limiter = self.get_limiter(model_name)
+            ticket = (priority, next(self.order))
+            heapq.heappush(limiter.waiting, ticket)
+        try:
+            with self.condition:
+                while True:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    taken, wait_time = self.try_take(limiter, ticket, tokens)
+                    if taken:
+                        return
+                    if cancel_token is not None:
+                        wait_time = CANCEL_POLL_INTERVAL if wait_time is None else min(wait_time, CANCEL_POLL_INTERVAL)
+                    self.condition.wait(wait_time)
+        finally:
+            self.release(limiter, ticket)
+
+    async def aacquire(self, model_name, tokens, priority=PRIORITY_BULK, cancel_token=None):
+        """
+        Async version of acquire(). Waits on a future the scheduler resolves when capacity may have freed up,
+        so no thread is held while waiting. A cancelled awaiter gives up its place in line without taking capacity.
+        """
+        self.check_size(model_name, tokens)
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            limiter = self.get_limiter(model_name)
+            ticket = (priority, next(self.order))
+            heapq.heappush(limiter.waiting, ticket)
+        try:
+            while True:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                with self.condition:
+                    taken, wait_time = self.try_take(limiter, ticket, tokens)
+                    if taken:
+                        return
+                    waker = (loop, loop.create_future())
+                    self.async_waiters.add(waker)
+                if cancel_token is not None:
+                    wait_time = CANCEL_POLL_INTERVAL if wait_time is None else min(wait_time, CANCEL_POLL_INTERVAL)
+                try:
+                    await asyncio.wait({waker[1]}, timeout=wait_time)
+                finally:
+                    with self.condition:
+                        self.async_waiters.discard(waker)
+        finally:
+            self.release(limiter, ticket)
+
+    def pause(self, model_name, seconds):
+        """
+        Stop sending to model_name for `seconds`, after the API rejected a call with 429.
+        """
+        with self.condition:
+            limiter = self.get_limiter(model_name)
+            limiter.paused_until = max(limiter.paused_until, time.monotonic() + seconds)
+            # Start again from an empty bucket so the queued calls don't all go out at once
+            limiter.requests.available = min(limiter.requests.available, 0)
+            self.wake_all()
+
+    @staticmethod
+    def get_endpoint(model_name):
+        return resilience.endpoint(f"gemini/{model_name.split('/')[-1]}")
+
+    def rate_limit_pause(self, model_name, error, delay):
+        print(f"LLM SCHEDULER: {model_name} is rate limited, queuing the call again.")
+        # Per-minute quotas free up slowly, wait at least LLM_RATE_LIMIT_PAUSE unless the API says when to come back
+        self.pause(model_name, retry_after(error) or max(delay, LLM_RATE_LIMIT_PAUSE))
+
+    def call(self, model_name, tokens, priority, cancel_token, function, *args, **kwargs):
+        """
+        Wait for capacity, then call function(*args, **kwargs). A 429 pauses the model and queues the call again,
+        other transient errors are retried with backoff, and the call fails fast while the model's circuit is open
+        (see utils/resilience.py). A call larger than the model's tokens per minute raises PromptTooLargeError.
+        """
+        # Before the endpoint is involved, an oversized call is not a failure of the model
+        self.check_size(model_name, tokens)
+        endpoint = self.get_endpoint(model_name)
+        for attempt in itertools.count():
+            endpoint.before_call()
+            try:
+                self.acquire(model_name, tokens, priority, cancel_token)
+                result = function(*args, **kwargs)
+            except google_exceptions.ResourceExhausted as e:
+                # The pause already holds back every caller of the model, so this retry doesn't add load
+                delay = endpoint.after_failure(e, attempt, use_budget=False)
+                if delay is None:
+                    raise
+                self.rate_limit_pause(model_name, e, delay)
+                continue
+            except Exception as e:
+                delay = endpoint.after_failure(e, attempt)
+                if delay is None:
+                    raise
+                print(f"LLM SCHEDULER: {model_name} failed ({e}), retrying in {delay:.1f}s.")
+                sleep(cancel_token, delay)
+                continue
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.record_success()
+            return result
+
+    async def acall(self, model_name, tokens, priority, cancel_token, function, *args, **kwargs):
+        """
+        Async version of call(), `function` returns an awaitable.
+        """
+        self.check_size(model_name, tokens)
+        endpoint = self.get_endpoint(model_name)
+        for attempt in itertools.count():
+            endpoint.before_call()
+            try:
+                await self.aacquire(model_name, tokens, priority, cancel_token)
+                result = await function(*args, **kwargs)
+            except google_exceptions.ResourceExhausted as e:
+                delay = endpoint.after_failure(e, attempt, use_budget=False)
+                if delay is None:
+                    raise
+                self.rate_limit_pause(model_name, e, delay)
+                continue
+            except Exception as e:
+                delay = endpoint.after_failure(e, attempt)
+                if delay is None:
+                    raise
+                print(f"LLM SCHEDULER: {model_name} failed ({e}), retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.record_success()
+            return result
+
+llm_scheduler = LLMScheduler(LLM_RATE_LIMITS, DEFAULT_LLM_RATE_LIMIT)
@@ -0,0 +1,39 @@
+import json
+import threading
+from utils.llm_backend import get_backend
+
+
+class ModelRegistry:
+    """
+    Shares model objects, created by the LLM backend, between agents and sessions. Models are cached by model name, tool signature
+    and safety settings, so declaring the tools (which inspects every tool function) is done once per process
+    instead of for every agent instance. Chats started from a shared model only hold their own history.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+
+    @staticmethod
+    def make_key(backend, model_name, tools, safety_settings):
+        tool_signature = tuple(sorted(f"{tool.__module__}.{tool.__qualname__}" for tool in tools or []))
+        return (id(backend), model_name, tool_signature, json.dumps(safety_settings, sort_keys=True, default=str))
+
+    def get(self, model_name, tools=None, safety_settings=None):
+        """
+        Return the model for these settings, creating it the first time.
+
+        Args:
+            model_name (str): e.g. 'gemini-1.5-pro-latest'.
+            tools (list): tool functions declared to the model.
+            safety_settings (dict): default safety settings of the model.
+        """
+        tools = list(tools) if tools else None
+        backend = get_backend()
+        key = self.make_key(backend, model_name, tools, safety_settings)
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = backend.create_model(model_name, tools, safety_settings)
+            return self.models[key]
+
+
+model_registry = ModelRegistry()
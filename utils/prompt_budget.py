@@ -0,0 +1,89 @@
+import random
+import threading
+import time
+from collections import deque
+
+
+def estimate_tokens(text):
+    # Gemini averages roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def truncate_items(agent, items, instruction, budget):
+    """
+    Keep items in order until the budget is used up, the last one cut short.
+    """
+    fitted = []
+    used = 0
+    for item in items:
+        tokens = estimate_tokens(item)
+        if used + tokens > budget:
+            remaining_chars = (budget - used) * 4
+            if remaining_chars > 0:
+                fitted.append(item[:remaining_chars])
+            break
+        fitted.append(item)
+        used += tokens
+    return fitted
+
+
+def sample_items(agent, items, instruction, budget):
+    """
+    Keep a random sample of the items that fits the budget, in their original order. Good for reviews and posts,
+    where a representative sample matters more than any single item.
+    """
+    order = list(range(len(items)))
+    random.shuffle(order)
+    kept = set()
+    used = 0
+    for index in order:
+        tokens = estimate_tokens(items[index])
+        if used + tokens <= budget:
+            kept.add(index)
+            used += tokens
+    return [item for index, item in enumerate(items) if index in kept]
+
+
+def summarize_items(agent, items, instruction, budget):
+    """
+    Condense the items with map-reduce summaries until they fit the budget. Keeps every item's content at the
+    cost of extra model calls.
+    """
+    return [agent.map_reduce_summarize(items, instruction, target_tokens=budget)]
+
+
+# Strategies used by AgentBase.fit_prompt. Add a function with the same signature to plug in another one
+REDUCTION_STRATEGIES = {
+    'truncate': truncate_items,
+    'sample': sample_items,
+    'summarize': summarize_items,
+}
+
+
+class PromptSizeLog:
+    """
+    Remembers the original and sent size of recent prompts, to see how much the budget cuts.
+    """
+    def __init__(self, max_entries=200):
+        self.lock = threading.Lock()
+        self.entries = deque(maxlen=max_entries)
+
+    def record(self, agent, model_name, strategy, original_tokens, sent_tokens, original_items, sent_items):
+        with self.lock:
+            self.entries.append({
+                'time': time.time(),
+                'agent': agent,
+                'model': model_name,
+                'strategy': strategy,
+                'original_tokens': original_tokens,
+                'sent_tokens': sent_tokens,
+                'original_items': original_items,
+                'sent_items': sent_items
+            })
+
+    def recent(self):
+        with self.lock:
+            return list(self.entries)
+
+
+prompt_size_log = PromptSizeLog()
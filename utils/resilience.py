@@ -0,0 +1,310 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+import aiohttp
+import prawcore
+import requests
+from google.api_core import exceptions as google_exceptions
+from app_constants import (RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_RETRIES,
+                           RETRY_BUDGET_WINDOW, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+# Failures before any response, worth trying again
+CONNECTION_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    aiohttp.ClientConnectionError,
+    prawcore.exceptions.RequestException,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint that is failing, until its circuit breaker lets a trial call through.
+    """
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} is unavailable, calls are suspended for {retry_in:.0f} more seconds.")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def status_code(error):
+    """
+    HTTP status of a failed call from the Gemini SDK, requests, aiohttp or praw, None if there was no response.
+    """
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code
+    status = getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def is_transient(error):
+    return status_code(error) in TRANSIENT_STATUSES or isinstance(error, CONNECTION_ERRORS)
+
+
+def is_rate_limited(error):
+    return status_code(error) == 429
+
+
+def retry_after(error):
+    """
+    Seconds the server asked to wait before retrying, from the Retry-After header or Gemini's RetryInfo, None if it didn't say.
+    """
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+class CircuitBreaker:
+    """
+    Counts transient failures in a row. At `failure_threshold` the circuit opens and calls fail fast for
+    `reset_timeout` seconds, then one trial call is let through: success closes the circuit, failure opens it again.
+    """
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: the circuit is open, or another caller is running the trial call.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self.trial_running:
+                raise CircuitOpenError(self.name, max(retry_in, 0))
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"CIRCUIT BREAKER: {self.name} is back, closing the circuit.")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or (self.opened_at is None and self.failures >= self.failure_threshold):
+                print(f"CIRCUIT BREAKER: {self.name} failed {self.failures} times in a row, failing fast for {self.reset_timeout}s.")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def release(self):
+        # The trial call was abandoned (e.g. cancelled) without telling whether the endpoint works
+        with self.lock:
+            self.trial_running = False
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() >= self.opened_at + self.reset_timeout else 'open'
+
+
+class RetryBudget:
+    """
+    Allows retries up to `ratio` of the calls made in the last `window` seconds, plus `min_retries`.
+    """
+    def __init__(self, ratio, min_retries, window):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.retries = deque()
+
+    def prune(self, now):
+        for times in (self.calls, self.retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def record_call(self):
+        with self.lock:
+            self.calls.append(time.monotonic())
+
+    def try_retry(self):
+        """
+        Take a retry from the budget. Returns False if it is used up.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.prune(now)
+            if len(self.retries) >= self.min_retries + self.ratio * len(self.calls):
+                return False
+            self.retries.append(now)
+            return True
+
+    def usage(self):
+        with self.lock:
+            self.prune(time.monotonic())
+            return len(self.calls), len(self.retries)
+
+
+class Endpoint:
+    """
+    One dependency (a Gemini model, the Steam API, Reddit...) with its circuit breaker and retry budget.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_RETRIES, RETRY_BUDGET_WINDOW)
+
+    def before_call(self):
+        self.breaker.before_call()
+        self.budget.record_call()
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def release(self):
+        self.breaker.release()
+
+    @staticmethod
+    def backoff(attempt):
+        # Full jitter, so callers that failed together don't come back together
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def after_failure(self, error, attempt, use_budget=True):
+        """
+        Record a failed call and decide whether to retry it.
+
+        Args:
+            error: the exception the call raised.
+            attempt (int): 0 for the first call.
+            use_budget (bool): take the retry from the retry budget.
+
+        Returns:
+            float: seconds to wait before retrying, or None if the error should be raised.
+        """
+        if not is_transient(error):
+            # The endpoint answered, the request itself is wrong
+            self.breaker.record_success()
+            return None
+        if is_rate_limited(error):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        if attempt >= RETRY_ATTEMPTS or self.breaker.is_open:
+            return None
+        if use_budget and not self.budget.try_retry():
+            print(f"RESILIENCE: Retry budget of {self.name} is used up, not retrying.")
+            return None
+        delay = retry_after(error)
+        return min(delay, RETRY_MAX_DELAY) if delay is not None else self.backoff(attempt)
+
+    def stats(self):
+        calls, retries = self.budget.usage()
+        return {'state': self.breaker.state(), 'failures_in_a_row': self.breaker.failures, 'calls': calls, 'retries': retries}
+
+
+def sleep(cancel_token, seconds):
+    if cancel_token is None:
+        time.sleep(seconds)
+    elif cancel_token.wait(seconds):
+        cancel_token.raise_if_cancelled()
+
+
+class Resilience:
+    """
+    Retries transient failures of the calls to a named endpoint with jittered exponential backoff (or Retry-After),
+    fails fast while the endpoint's circuit is open and stops retrying when its retry budget is used up.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def endpoint(self, name):
+        with self.lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = Endpoint(name)
+            return self.endpoints[name]
+
+    def call(self, name, cancel_token, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs), retrying transient errors. Waits between retries end early if cancel_token is cancelled.
+
+        Raises:
+            CircuitOpenError: the endpoint is failing.
+        """
+        endpoint = self.endpoint(name)
+        for attempt in itertools.count():
+            endpoint.before_call()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                delay = endpoint.after_failure(e, attempt)
+                if delay is None:
+                    raise
+                print(f"RESILIENCE: {name} failed ({e}), retrying in {delay:.1f}s.")
+                sleep(cancel_token, delay)
+                continue
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.record_success()
+            return result
+
+    async def acall(self, name, function, *args, **kwargs):
+        """
+        Async version of call(), `function` returns an awaitable. Cancelled like any other coroutine.
+        """
+        endpoint = self.endpoint(name)
+        for attempt in itertools.count():
+            endpoint.before_call()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as e:
+                delay = endpoint.after_failure(e, attempt)
+                if delay is None:
+                    raise
+                print(f"RESILIENCE: {name} failed ({e}), retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.record_success()
+            return result
+
+    def stats(self):
+        with self.lock:
+            endpoints = dict(self.endpoints)
+        return {name: endpoint.stats() for name, endpoint in endpoints.items()}
+
+
+resilience = Resilience()
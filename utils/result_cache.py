@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ResultCache:
+    """
+    Persistent cache of agent results, stored as one JSON file. Each entry remembers when it was created,
+    and callers pass the freshness window (ttl) when reading, so every agent can have its own policy.
+    """
+    def __init__(self, path, max_entries=500):
+        """
+        Args:
+            path (str): JSON file the cache is stored in.
+            max_entries (int): the oldest entries are dropped beyond this many.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self):
+        # Called with self.lock held. Write to a temporary file first so a crash never leaves a half written cache
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key, ttl):
+        """
+        Return the cached value for key if it is younger than ttl seconds, otherwise None.
+        """
+        if not ttl or ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry['created_at'] > ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = {'created_at': time.time(), 'value': value}
+            if len(self.entries) > self.max_entries:
+                oldest = sorted(self.entries, key=lambda entry_key: self.entries[entry_key]['created_at'])
+                for entry_key in oldest[:len(self.entries) - self.max_entries]:
+                    del self.entries[entry_key]
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.save()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class SessionPool:
+    """
+    Keeps one object (e.g. an AgentManager) per client session. Sessions idle for longer than idle_timeout
+    are dropped, and the least recently used session is evicted once there are more than max_sessions.
+    Sessions that are busy handling a request are never evicted.
+    """
+    def __init__(self, factory, max_sessions, idle_timeout, on_drop=None):
+        """
+        Args:
+            factory (callable): creates the object for a new session.
+            max_sessions (int): maximum number of sessions kept in memory.
+            idle_timeout (float): seconds after which an unused session is dropped.
+            on_drop (callable): called with (session id, object) of a dropped session, e.g. to stop its background work.
+        """
+        self.factory = factory
+        self.on_drop = on_drop
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        Use the session's object, creating it if needed. Requests from the same session run one at a time
+        while other sessions run in parallel.
+
+            with pool.session(session_id) as manager:
+                ...
+        """
+        with self.lock:
+            dropped = self.evict_idle(session_id)
+            session = self.sessions.get(session_id)
+            if session is None:
+                # Only a new session needs room, the requested one is never evicted
+                dropped += self.evict_least_recently_used(self.max_sessions - 1)
+                print(f"SESSION POOL: Creating session {session_id}")
+                session = {'value': None, 'lock': threading.Lock(), 'last_used': time.monotonic(), 'users': 0}
+                self.sessions[session_id] = session
+            # Counted as busy from here so it can't be evicted before this request takes its lock
+            session['users'] += 1
+            session['last_used'] = time.monotonic()
+            self.sessions.move_to_end(session_id)
+        # Outside the pool lock, on_drop may be slow
+        for dropped_id, dropped_session in dropped:
+            self.drop(dropped_id, dropped_session)
+
+        try:
+            with session['lock']:
+                # Created outside the pool lock, building an object can be slow
+                if session['value'] is None:
+                    session['value'] = self.factory()
+                yield session['value']
+        finally:
+            with self.lock:
+                session['users'] -= 1
+                session['last_used'] = time.monotonic()
+
+    def reset(self, session_id):
+        """
+        Drop the session's object so the next request starts from a fresh one. Requests already running
+        keep using the old object until they finish.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.drop(session_id, session)
+
+    def peek(self, session_id):
+        """
+        The session's object without waiting for its lock, None if the session has none. Only for thread-safe
+        calls, e.g. cancelling the session's background work while it handles a request.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return session['value'] if session is not None else None
+
+    def drop(self, session_id, session):
+        if self.on_drop is None or session['value'] is None:
+            return
+        try:
+            self.on_drop(session_id, session['value'])
+        except Exception as e:
+            print(f"SESSION POOL: Dropping a session failed: {e}")
+
+    def evict_idle(self, keep):
+        """
+        Called with self.lock held. Remove sessions idle for longer than idle_timeout, except `keep`.
+
+        Returns:
+            list: (session id, session) of the removed sessions, to be dropped once the lock is released.
+        """
+        now = time.monotonic()
+        evicted = []
+        for session_id, session in list(self.sessions.items()):
+            if session_id != keep and session['users'] == 0 and now - session['last_used'] > self.idle_timeout:
+                print(f"SESSION POOL: Dropping idle session {session_id}")
+                evicted.append((session_id, self.sessions.pop(session_id)))
+        return evicted
+
+    def evict_least_recently_used(self, max_sessions):
+        """
+        Called with self.lock held. Remove the least recently used idle sessions until at most max_sessions are left.
+
+        Returns:
+            list: (session id, session) of the removed sessions, to be dropped once the lock is released.
+        """
+        evicted = []
+        idle_sessions = [session_id for session_id, session in self.sessions.items() if session['users'] == 0]
+        while len(self.sessions) > max_sessions and idle_sessions:
+            session_id = idle_sessions.pop(0)
+            print(f"SESSION POOL: Evicting least recently used session {session_id}")
+            evicted.append((session_id, self.sessions.pop(session_id)))
+        return evicted
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
@@ -0,0 +1,155 @@
+import asyncio
+import functools
+import inspect
+import re
+import threading
+from utils.cancellation import CANCEL_POLL_INTERVAL, TaskCancelled
+
+
+def normalize_argument(value):
+    """
+    Normalize a tool argument so calls that mean the same thing get the same key,
+    e.g. "Elden Ring " and "elden ring", or ['pcgaming', 'Games'] and ['games', 'pcgaming'].
+    """
+    if isinstance(value, str):
+        return re.sub(r"\s+", " ", value).strip().lower()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple, set)):
+        normalized = [normalize_argument(item) for item in value]
+        return tuple(sorted(normalized, key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), normalize_argument(item)) for key, item in value.items()))
+    return value
+
+
+def make_call_key(function, args, kwargs):
+    """
+    Build the key for a method call from its normalized arguments. Defaults are filled in and self is left out,
+    so the same call made on two agent instances (e.g. two users' sessions) gets the same key.
+    Returns None if the arguments can't be used as a key.
+    """
+    bound = inspect.signature(function).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = tuple((name, normalize_argument(value)) for name, value in bound.arguments.items() if name != 'self')
+    key = (function.__module__, function.__qualname__, arguments)
+    try:
+        hash(key)
+    except TypeError:
+        # Arguments we can't compare, don't coalesce
+        return None
+    return key
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time: the first caller runs the function,
+    callers that arrive while it is running wait for that run and get the same result (or exception).
+    If the leader is cancelled its followers don't get the cancellation, one of them runs the function instead.
+    Followers wait in short intervals and stop as soon as their own cancel_token is cancelled.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+
+    def do(self, key, cancel_token, function, *args, **kwargs):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = {'done': threading.Event(), 'result': None, 'error': None, 'cancelled': False}
+                    self.calls[key] = call
+            if leader:
+                break
+
+            print(f"SINGLE FLIGHT: Waiting for identical in-flight call {key[1]}")
+            while not call['done'].wait(CANCEL_POLL_INTERVAL):
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+            if call['cancelled']:
+                print(f"SINGLE FLIGHT: In-flight call {key[1]} was cancelled, running it again")
+                continue
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = function(*args, **kwargs)
+            return call['result']
+        except TaskCancelled:
+            # The leader's request was cancelled, not the followers'
+            call['cancelled'] = True
+            raise
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+    async def ado(self, key, cancel_token, function, *args, **kwargs):
+        # Coroutines all run on the shared event loop, so no lock is needed
+        while True:
+            future = self.async_calls.get(key)
+            if future is None:
+                break
+
+            print(f"SINGLE FLIGHT: Waiting for identical in-flight call {key[1]}")
+            # asyncio.wait doesn't cancel the shared future when this follower is cancelled
+            while not future.done():
+                await asyncio.wait({future}, timeout=CANCEL_POLL_INTERVAL)
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+            if future.cancelled():
+                print(f"SINGLE FLIGHT: In-flight call {key[1]} was cancelled, running it again")
+                continue
+            return future.result()
+
+        future = asyncio.get_running_loop().create_future()
+        self.async_calls[key] = future
+        try:
+            result = await function(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except (asyncio.CancelledError, TaskCancelled):
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.async_calls[key]
+
+
+single_flight_group = SingleFlight()
+
+
+def single_flight(function):
+    """
+    Decorator for agent tool functions: concurrent calls with the same normalized arguments, from any agent
+    instance, share one execution. Works with regular and async functions. Waiting callers are cancelled
+    with their own agent's cancel_token.
+    """
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            key = make_call_key(function, args, kwargs)
+            if key is None:
+                return await function(*args, **kwargs)
+            cancel_token = getattr(args[0], 'cancel_token', None) if args else None
+            return await single_flight_group.ado(key, cancel_token, function, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        key = make_call_key(function, args, kwargs)
+        if key is None:
+            return function(*args, **kwargs)
+        cancel_token = getattr(args[0], 'cancel_token', None) if args else None
+        return single_flight_group.do(key, cancel_token, function, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,129 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.cancellation import CANCEL_POLL_INTERVAL
+
+
+class TaskGraphError(ValueError):
+    pass
+
+
+class TaskGraph:
+    """
+    A set of agent tasks with data dependencies between them. Each node is one agent + instruction, and
+    node N only starts once every node it depends on has completed.
+    """
+    def __init__(self, agents, instructions, dependencies):
+        """
+        Args:
+            agents (list[str]): agent key for each node.
+            instructions (list[str]): instruction for each node.
+            dependencies (list[str]): for each node, comma separated indexes of the nodes it depends on, e.g. "0,2". Empty string for none.
+        """
+        if not (len(agents) == len(instructions) == len(dependencies)):
+            raise TaskGraphError("agents, instructions and dependencies must have the same length.")
+
+        self.nodes = []
+        for index, (agent, instruction, depends_on) in enumerate(zip(agents, instructions, dependencies)):
+            self.nodes.append({
+                'id': index,
+                'agent': agent,
+                'instruction': instruction,
+                'depends_on': self.parse_dependencies(index, depends_on, len(agents))
+            })
+        self.check_for_cycles()
+
+    @staticmethod
+    def parse_dependencies(index, depends_on, node_count):
+        parsed = []
+        for item in str(depends_on or "").replace(" ", "").split(","):
+            if not item:
+                continue
+            try:
+                dependency = int(float(item))
+            except ValueError:
+                raise TaskGraphError(f"Task {index} has an invalid dependency: '{item}'.")
+            if dependency == index or not 0 <= dependency < node_count:
+                raise TaskGraphError(f"Task {index} has an invalid dependency: {dependency}.")
+            if dependency not in parsed:
+                parsed.append(dependency)
+        return parsed
+
+    def check_for_cycles(self):
+        remaining = {node['id']: set(node['depends_on']) for node in self.nodes}
+        while remaining:
+            ready = [node_id for node_id, depends_on in remaining.items() if not depends_on]
+            if not ready:
+                raise TaskGraphError(f"Tasks {sorted(remaining)} depend on each other in a cycle.")
+            for node_id in ready:
+                del remaining[node_id]
+            for depends_on in remaining.values():
+                depends_on.difference_update(ready)
+
+    def run(self, run_node, timeout, cancel_token=None, deadline=None):
+        """
+        Run the graph. Independent nodes run at the same time and dependents start as soon as all their inputs are in.
+
+        Args:
+            run_node (callable): run_node(node, inputs) -> result, where inputs maps dependency id to its result.
+            timeout (float): maximum seconds each node may run.
+            cancel_token (CancelToken): stop waiting and raise TaskCancelled once cancelled.
+            deadline (Deadline): no node is waited for past it, however late it started.
+
+        Returns:
+            dict: node id -> {'status': 'completed' | 'failed' | 'timed_out' | 'skipped', 'result': ..., 'error': ...}
+        """
+        outcomes = {}
+        running = {}
+        deadlines = {}
+        executor = ThreadPoolExecutor(max_workers=max(len(self.nodes), 1), thread_name_prefix="task")
+
+        def start_ready_nodes():
+            for node in self.nodes:
+                if node['id'] in outcomes or node['id'] in running.values():
+                    continue
+                statuses = [outcomes.get(dependency, {}).get('status') for dependency in node['depends_on']]
+                if any(status not in (None, 'completed') for status in statuses):
+                    outcomes[node['id']] = {'status': 'skipped', 'error': "A task it depends on did not complete."}
+                elif all(status == 'completed' for status in statuses) and deadline is not None and deadline.expired:
+                    outcomes[node['id']] = {'status': 'timed_out', 'error': "The request's deadline passed before it could start."}
+                elif all(status == 'completed' for status in statuses):
+                    inputs = {dependency: outcomes[dependency]['result'] for dependency in node['depends_on']}
+                    future = executor.submit(run_node, node, inputs)
+                    running[future] = node['id']
+                    deadlines[future] = time.monotonic() + timeout
+                    if deadline is not None:
+                        deadlines[future] = min(deadlines[future], deadline.expires_at)
+
+        start_ready_nodes()
+        while running:
+            if cancel_token is not None and cancel_token.cancelled:
+                executor.shutdown(wait=False)
+                cancel_token.raise_if_cancelled()
+            next_deadline = min(deadlines[future] for future in running)
+            wait_time = max(next_deadline - time.monotonic(), 0)
+            if cancel_token is not None:
+                wait_time = min(wait_time, CANCEL_POLL_INTERVAL)
+            done, _ = wait(list(running), timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in list(running):
+                if future in done:
+                    node_id = running.pop(future)
+                    if future.exception() is not None:
+                        outcomes[node_id] = {'status': 'failed', 'error': str(future.exception())}
+                    else:
+                        outcomes[node_id] = {'status': 'completed', 'result': future.result()}
+                elif time.monotonic() >= deadlines[future]:
+                    node_id = running.pop(future)
+                    if deadline is not None and deadlines[future] == deadline.expires_at:
+                        error = "Did not finish before the request's deadline."
+                    else:
+                        error = f"Did not finish within {timeout} seconds."
+                    outcomes[node_id] = {'status': 'timed_out', 'error': error}
+            # A skipped node can unblock nothing, but it may skip its own dependents, so repeat until stable
+            count = None
+            while count != len(outcomes) + len(running):
+                count = len(outcomes) + len(running)
+                start_ready_nodes()
+
+        # Don't block on nodes that are still running after their deadline
+        executor.shutdown(wait=False)
+        return outcomes